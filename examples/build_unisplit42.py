@@ -3,10 +3,13 @@ import sys
 from kbtb.keyboard import save_keyboard
 from kbtb.keyboard_pb2 import Keyboard
 from kbtb.layout import holes_between_keys, project_to_outline, mirror_keys, rotate_keys, grid, pose_closest_point, between_pose, pose_closest_point
+from kbtb.matrix import fill_matrix_rows
 from kbtb.outline import generate_outline_tight
 
 
-def main():
+def unisplit42(column_offsets=(-1.6, 0.0, 8.0, 3.6, -7.68, -10.08),
+               angle=51,
+               arc_radius=90):
     kb = Keyboard(
         name="unisplit42",
         info_text="unisplit42\npeterklein.dev",
@@ -17,20 +20,18 @@ def main():
 
     pitch = 19.05
 
-    column_offsets = [-1.6, 0.0, 8.0, 3.6, -7.68, -10.08]
-
     keys = [
         *(grid(x, 3, y_offset=column_offsets[x]) for x in range(6)),
         *(grid(x, 2, y_offset=column_offsets[x]) for x in range(6)),
         *(grid(x, 1, y_offset=column_offsets[x]) for x in range(6)),
         *(grid(
             x,
-            arc_radius=90,
+            arc_radius=arc_radius,
             x_offset=-0.65 * pitch,
             y_offset=column_offsets[0] + 1) for x in range(3)),
     ]
 
-    for key in mirror_keys(rotate_keys(keys, angle=51)):
+    for key in mirror_keys(rotate_keys(keys, angle=angle)):
         kb.keys.append(key)
 
     for hole in holes_between_keys(kb.keys,
@@ -51,13 +52,7 @@ def main():
     kb.controller_pose.CopyFrom(
         between_pose(kb.keys[17].pose, kb.keys[18].pose))
 
-    # TODO: un-hardcode
-    row_nets = (0, 5, 6, 7)
-    col_nets = list(reversed((1, 2, 3, 4, 8, 9, 10, 11, 12, 13, 14, 15)))
-    for i, key in enumerate(kb.keys):
-        key.controller_pin_low = row_nets[i // 12]
-        key.controller_pin_high = col_nets[(i % 12) +
-                                           (3 if i // 12 == 3 else 0)]
+    fill_matrix_rows(kb, topology="geometry")
 
     for x, y in outline.coords:
         kb.outline_polygon.add(x=x, y=y)
@@ -75,8 +70,12 @@ def main():
         38, 39, 40, 41
     ]
 
+    return kb
+
+
+def main():
     with open(sys.argv[1], 'wb') as fn:
-        fn.write(kb.SerializeToString())
+        fn.write(unisplit42().SerializeToString())
 
 
 if __name__ == "__main__":
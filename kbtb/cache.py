@@ -0,0 +1,199 @@
+"""Content-addressed on-disk cache for generated artifacts.
+
+Entries are keyed by a hash of the generator and its source, its
+arguments, the kbtb sources and footprints and the versions of the
+libraries producing artifacts. Keyboard messages are hashed by their
+deterministic binary serialization, shapely geometry by its WKB and
+numpy arrays by their dtype, shape and contents so equal inputs always
+map to the same entry. The cache is bounded in size and evicts the
+least recently used entries first.
+
+    cache = ArtifactCache("/tmp/kbtb-cache")
+    generate_plate = cache.wrap(kbtb.plate.generate_plate)
+    plate = generate_plate(kb, mounting_holes=True)
+"""
+
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import shapely
+from google.protobuf.message import Message
+
+
+def _library_versions():
+    versions = [f"numpy {np.__version__}", f"shapely {shapely.__version__}"]
+    try:
+        import ezdxf
+        versions.append(f"ezdxf {ezdxf.__version__}")
+    except ImportError:
+        pass
+    try:
+        import pcbnew
+        versions.append(f"pcbnew {pcbnew.GetBuildVersion()}")
+    except ImportError:
+        pass
+    return versions
+
+
+@functools.lru_cache(maxsize=None)
+def code_version():
+    """Hash everything generated artifacts depend on besides their inputs.
+
+    This covers every kbtb source file including the command line
+    tools, the bundled KiCad footprints and the versions of the
+    libraries that write artifacts, so changing any of them
+    invalidates entries.
+    """
+    h = hashlib.sha256()
+    root = os.path.dirname(os.path.abspath(__file__))
+    paths = (glob.glob(os.path.join(root, "**", "*.py"), recursive=True) +
+             glob.glob(os.path.join(root, "kicad_modules", "*.kicad_mod")))
+    for path in sorted(paths):
+        h.update(os.path.relpath(path, root).encode() + b"\0")
+        with open(path, "rb") as fp:
+            h.update(hashlib.sha256(fp.read()).digest())
+    for version in _library_versions():
+        h.update(version.encode() + b"\0")
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _source_version(path):
+    with open(path, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+def _function_version(fn):
+    """Hash the source file of fn, which may live outside kbtb."""
+    try:
+        path = inspect.getsourcefile(fn)
+    except TypeError:
+        path = None  # builtins have no source
+    return _source_version(path) if path else ""
+
+
+def _join(digests):
+    # Prefix every part with its length so that parts cannot run together
+    return b"".join(len(d).to_bytes(8, "little") + d for d in digests)
+
+
+def _digest(value):
+    """Serialize one part of a cache key, tagged with its type.
+
+    Only types with an exact, stable encoding are accepted; anything else
+    raises TypeError rather than risk two different values colliding.
+    """
+    if isinstance(value, Message):
+        return (type(value).__name__.encode() +
+                value.SerializeToString(deterministic=True))
+    if isinstance(value, shapely.Geometry):
+        return shapely.to_wkb(value)
+    if isinstance(value, (np.ndarray, np.generic)):
+        value = np.asarray(value)
+        if value.dtype.hasobject:
+            raise TypeError("cannot hash numpy arrays of objects")
+        return _join([
+            b"ndarray",
+            value.dtype.str.encode(),
+            repr(value.shape).encode(),
+            np.ascontiguousarray(value).tobytes(),
+        ])
+    if value is None or isinstance(value, (bool, int, float, str, bytes)):
+        # repr round-trips exactly for these, including floats
+        return type(value).__name__.encode() + b":" + repr(value).encode()
+    if isinstance(value, (tuple, list)):
+        return _join([type(value).__name__.encode()] +
+                     [_digest(v) for v in value])
+    if isinstance(value, dict):
+        return _join([b"dict"] + sorted(
+            _join([_digest(k), _digest(v)]) for k, v in value.items()))
+    raise TypeError(f"cannot build a cache key from {type(value).__name__}")
+
+
+class ArtifactCache:
+    """A size-bounded LRU cache of pickled values in a directory."""
+
+    def __init__(self, path, max_size=1 << 30):
+        self.path = path
+        self.max_size = max_size
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, *parts):
+        """Build a cache key from generator names, messages and parameters."""
+        h = hashlib.sha256(code_version().encode())
+        h.update(_join(_digest(part) for part in parts))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self.path, key + ".pickle")
+
+    def get_or_create(self, key, create):
+        """Return the value stored under key, calling create on a miss."""
+        path = self._entry(key)
+        try:
+            with open(path, "rb") as fp:
+                value = pickle.load(fp)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            pass
+        else:
+            os.utime(path)  # mark as recently used
+            self.stats["hits"] += 1
+            return value
+
+        self.stats["misses"] += 1
+        value = create()
+
+        # write atomically so concurrent builds never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fp:
+            pickle.dump(value, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+        self.evict()
+        return value
+
+    def call(self, fn, *args, **kwargs):
+        """Call fn through the cache."""
+        key = self.key(fn.__module__, fn.__qualname__, _function_version(fn),
+                       len(args), *args,
+                       *(x for item in sorted(kwargs.items()) for x in item))
+        return self.get_or_create(key, lambda: fn(*args, **kwargs))
+
+    def wrap(self, fn):
+        """Return a cached version of fn."""
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return self.call(fn, *args, **kwargs)
+
+        return wrapper
+
+    def evict(self):
+        """Remove least recently used entries until under max_size."""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".pickle"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.path, "*.pickle")):
+            os.remove(path)
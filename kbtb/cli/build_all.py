@@ -0,0 +1,223 @@
+"""Generate every artifact for a keyboard definition in one process."""
+
+import concurrent.futures
+import os
+
+from absl import app, flags, logging
+
+from kbtb.cache import ArtifactCache
+from kbtb.dxf import polygon_to_dxf_file
+from kbtb.keyboard import load_keyboard
+from kbtb.keyboard_pb2 import Keyboard
+from kbtb.kicad import polygon_to_kicad_file
+from kbtb.kle import keyboard_to_kle_file
+from kbtb.pcb import generate_kicad_pcb_file
+from kbtb.plate import generate_plate
+from kbtb.qmk import make_qmk_files
+from kbtb.svg import keyboard_to_layout_svg_file
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('input', '', 'Input path.')
+flags.DEFINE_string('plate_top_dxf', None, 'Top plate DXF output path.')
+flags.DEFINE_string('plate_bottom_dxf', None, 'Bottom plate DXF output path.')
+flags.DEFINE_string('svg', None, 'Layout preview SVG output path.')
+flags.DEFINE_string('kicad_pcb', None, 'Main PCB output path.')
+flags.DEFINE_string('plate_top_pcb', None, 'Top plate PCB output path.')
+flags.DEFINE_string('plate_bottom_pcb', None, 'Bottom plate PCB output path.')
+flags.DEFINE_string('qmk', None, 'QMK info.json output path.')
+flags.DEFINE_string('qmk_config', None, 'QMK config.h output path.')
+flags.DEFINE_string('qmk_keymap', None, 'QMK default keymap.c output path.')
+flags.DEFINE_string('kle', None, 'KLE JSON output path.')
+flags.DEFINE_list('catalog', [], 'Keyboard proto paths to build into '
+                  '--output_dir, replacing --input and the per-artifact paths.')
+flags.DEFINE_string('output_dir', None, 'Output directory for --catalog.')
+flags.DEFINE_string('cache_dir', None,
+                    'Directory for a local content-addressed artifact cache.')
+flags.DEFINE_integer('jobs', 1, 'Number of worker processes, 0 for one per '
+                     'core and 1 to build in-process.')
+
+
+class Plates:
+    """Lazily generate each plate once and share it between outputs.
+
+    QMK files are generated together in one pass and shared the same
+    way.
+    """
+
+    def __init__(self, kb):
+        self.kb = kb
+        self._top = None
+        self._bottom = None
+        self._qmk = None
+
+    @property
+    def qmk(self):
+        if self._qmk is None:
+            self._qmk = make_qmk_files(self.kb)
+        return self._qmk
+
+    @property
+    def top(self):
+        if self._top is None:
+            self._top = generate_plate(self.kb,
+                                       mounting_holes=False,
+                                       cutouts=True)
+        return self._top
+
+    @property
+    def bottom(self):
+        if self._bottom is None:
+            self._bottom = generate_plate(self.kb,
+                                          mounting_holes=True,
+                                          cutouts=False)
+        return self._bottom
+
+
+# Functions of (keyboard, plates) returning the bytes of each artifact
+ARTIFACTS = {
+    'plate_top_dxf':
+    lambda kb, p: polygon_to_dxf_file(p.top, reproducible=True),
+    'plate_bottom_dxf':
+    lambda kb, p: polygon_to_dxf_file(p.bottom, reproducible=True),
+    'svg': lambda kb, p: keyboard_to_layout_svg_file(kb, plate=p.top),
+    'kicad_pcb': lambda kb, p: generate_kicad_pcb_file(kb),
+    'plate_top_pcb': lambda kb, p: polygon_to_kicad_file(p.top),
+    'plate_bottom_pcb': lambda kb, p: polygon_to_kicad_file(p.bottom),
+    'qmk': lambda kb, p: p.qmk.info_json.encode('utf-8'),
+    'qmk_config': lambda kb, p: p.qmk.config_h.encode('utf-8'),
+    'qmk_keymap': lambda kb, p: p.qmk.keymap_c.encode('utf-8'),
+    'kle': lambda kb, p: keyboard_to_kle_file(kb).encode('utf-8'),
+}
+
+# Artifacts built together in one pool task because they share a plate
+# or other intermediate. Each keyboard is split into these groups so its
+# generators run concurrently while each plate is still built once.
+TASK_GROUPS = [
+    ('plate_top_dxf', 'svg', 'plate_top_pcb'),
+    ('plate_bottom_dxf', 'plate_bottom_pcb'),
+    ('kicad_pcb',),
+    ('qmk', 'qmk_config', 'qmk_keymap', 'kle'),
+]
+
+
+# File name suffixes used for catalog outputs, matching defs.bzl
+OUTPUT_SUFFIXES = {
+    'plate_top_dxf': '_plate_top.dxf',
+    'plate_bottom_dxf': '_plate_bottom.dxf',
+    'svg': '.svg',
+    'kicad_pcb': '.kicad_pcb',
+    'plate_top_pcb': '_plate_top.kicad_pcb',
+    'plate_bottom_pcb': '_plate_bottom.kicad_pcb',
+    'qmk': '-info.json',
+    'qmk_config': '-config.h',
+    'qmk_keymap': '-keymap.c',
+    'kle': '-kle.json',
+}
+
+
+def generate_artifacts(kb_bytes, names, cache_dir=None):
+    """Generate the named artifacts from a serialized keyboard.
+
+    Workers receive the serialized proto rather than shapely objects so
+    that nothing expensive has to be pickled. Returns the artifacts and
+    the cache statistics, which are None when no cache_dir is set.
+    """
+    kb = Keyboard()
+    kb.ParseFromString(kb_bytes)
+    plates = Plates(kb)
+    if cache_dir is None:
+        return [ARTIFACTS[name](kb, plates) for name in names], None
+
+    cache = ArtifactCache(cache_dir)
+    return [
+        cache.get_or_create(cache.key("build_all", name, kb),
+                            lambda: ARTIFACTS[name](kb, plates))
+        for name in names
+    ], cache.stats
+
+
+def _split_outputs(outputs):
+    """Split outputs into one dict per non-empty entry of TASK_GROUPS."""
+    grouped = set(name for group in TASK_GROUPS for name in group)
+    groups = TASK_GROUPS + [tuple(n for n in outputs if n not in grouped)]
+    for group in groups:
+        task = {name: outputs[name] for name in group if name in outputs}
+        if task:
+            yield task
+
+
+def build_catalog(builds, jobs=1, cache_dir=None):
+    """Build artifacts for many keyboards.
+
+    builds is a sequence of (keyboard, outputs) pairs where outputs maps
+    artifact names to paths. With jobs other than 1 each keyboard is
+    split into one process pool task per entry of TASK_GROUPS, so even
+    a single keyboard builds in parallel. Files are written in
+    submission order and are byte-identical to an in-process build.
+    Artifacts are looked up in and stored to cache_dir when it is set
+    and the combined cache statistics are returned.
+    """
+    builds = [(kb.SerializeToString(deterministic=True), outputs)
+              for kb, outputs in builds]
+    stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def write(outputs, results, build_stats):
+        for path, data in zip(outputs.values(), results):
+            with open(path, 'wb') as output:
+                output.write(data)
+        for name, count in (build_stats or {}).items():
+            stats[name] += count
+
+    if jobs == 1:
+        for kb_bytes, outputs in builds:
+            write(outputs,
+                  *generate_artifacts(kb_bytes, list(outputs), cache_dir))
+        return stats
+
+    with concurrent.futures.ProcessPoolExecutor(jobs or None) as pool:
+        futures = [(task,
+                    pool.submit(generate_artifacts, kb_bytes, list(task),
+                                cache_dir))
+                   for kb_bytes, outputs in builds
+                   for task in _split_outputs(outputs)]
+        for outputs, future in futures:
+            write(outputs, *future.result())
+    return stats
+
+
+def build_artifacts(kb, outputs, jobs=1, cache_dir=None):
+    """Write each artifact named in outputs to its path."""
+    return build_catalog([(kb, outputs)], jobs, cache_dir)
+
+
+def catalog_outputs(input_path, output_dir):
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    return {
+        artifact: os.path.join(output_dir, name + suffix)
+        for artifact, suffix in OUTPUT_SUFFIXES.items()
+    }
+
+
+def main(argv):
+    if FLAGS.catalog:
+        if not FLAGS.output_dir:
+            raise ValueError("--catalog requires --output_dir")
+        stats = build_catalog([(load_keyboard(path),
+                                catalog_outputs(path, FLAGS.output_dir))
+                               for path in FLAGS.catalog], FLAGS.jobs,
+                              FLAGS.cache_dir)
+    else:
+        kb = load_keyboard(FLAGS.input)
+        outputs = {
+            name: getattr(FLAGS, name)
+            for name in ARTIFACTS if getattr(FLAGS, name)
+        }
+        stats = build_artifacts(kb, outputs, FLAGS.jobs, FLAGS.cache_dir)
+
+    if FLAGS.cache_dir:
+        logging.info("artifact cache: %d hits, %d misses, %d evictions",
+                     stats["hits"], stats["misses"], stats["evictions"])
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -2,7 +2,7 @@
 
 from absl import app, flags
 
-from kbtb.dxf import polygon_to_dxf_file
+from kbtb.dxf import write_polygon_dxf
 from kbtb.keyboard import load_keyboard
 from kbtb.plate import generate_plate
 
@@ -12,6 +12,8 @@ flags.DEFINE_string('output', '', 'Output path.')
 flags.DEFINE_string('plate_type', 'top', 'Plate type.')
 flags.DEFINE_enum('format', 'plate_dxf', ['plate_dxf'],
                   'Type of output to generate.')
+flags.DEFINE_enum('dxf_format', 'asc', ['asc', 'bin'],
+                  'Write text or binary DXF.')
 
 
 def generate_plate_by_type(kb):
@@ -25,9 +27,8 @@ def main(argv):
     kb = load_keyboard(FLAGS.input)
 
     if FLAGS.format == 'plate_dxf':
-        with open(FLAGS.output, 'wb') as output:
-            plate = generate_plate_by_type(kb)
-            output.write(polygon_to_dxf_file(plate))
+        plate = generate_plate_by_type(kb)
+        write_polygon_dxf(plate, FLAGS.output, FLAGS.dxf_format)
 
     else:
         raise ValueError("unknown --format value")
@@ -3,20 +3,29 @@
 from absl import app, flags
 
 from kbtb.keyboard import load_keyboard
-from kbtb.kle import keyboard_to_kle_file
+from kbtb.kle import keyboard_to_kle_file, write_kle_stream
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('input', '', 'Input path.')
 flags.DEFINE_string('output', '', 'Output path.')
-flags.DEFINE_enum('format', 'kle', ['kle'], 'Type of output to generate.')
+flags.DEFINE_enum('format', 'kle', ['kle', 'jsonl'],
+                  'Type of output to generate.')
+flags.DEFINE_list('catalog', [], 'Input paths for --format=jsonl.')
+flags.DEFINE_enum('topology', 'order', ['order', 'geometry'],
+                  'How to split keys into kle rows.')
 
 
 def main(argv):
-    kb = load_keyboard(FLAGS.input)
-
     if FLAGS.format == 'kle':
+        kb = load_keyboard(FLAGS.input)
+        with open(FLAGS.output, 'w') as output:
+            output.write(keyboard_to_kle_file(kb, topology=FLAGS.topology))
+
+    elif FLAGS.format == 'jsonl':
         with open(FLAGS.output, 'w') as output:
-            output.write(keyboard_to_kle_file(kb))
+            write_kle_stream((load_keyboard(path) for path in FLAGS.catalog),
+                             output,
+                             topology=FLAGS.topology)
 
     else:
         raise ValueError("unknown --format value")
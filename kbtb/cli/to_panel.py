@@ -0,0 +1,49 @@
+"""Pack plates from many keyboard definitions into one DXF sheet."""
+
+from absl import app, flags, logging
+
+from kbtb.dxf import write_polygons_dxf
+from kbtb.keyboard import load_keyboard
+from kbtb.panel import panelize
+from kbtb.plate import generate_plate
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list('input', [], 'Input paths.')
+flags.DEFINE_string('output', '', 'Output path.')
+flags.DEFINE_list('plate_type', ['top', 'bottom'],
+                  'Plate types to include for every keyboard.')
+flags.DEFINE_float('sheet_width', 1200, 'Sheet width in mm.')
+flags.DEFINE_float('sheet_height', 600, 'Sheet height in mm.')
+flags.DEFINE_float('kerf', 3, 'Spacing between parts in mm.')
+flags.DEFINE_float('margin', 5, 'Spacing around the sheet edge in mm.')
+flags.DEFINE_enum('dxf_format', 'asc', ['asc', 'bin'],
+                  'Write text or binary DXF.')
+
+
+def generate_plate_by_type(kb, plate_type):
+    if plate_type == "top":
+        return generate_plate(kb, mounting_holes=False, cutouts=True)
+    if plate_type == "bottom":
+        return generate_plate(kb, mounting_holes=True, cutouts=False)
+    raise ValueError(f"unknown plate type: {plate_type}")
+
+
+def main(argv):
+    plates = [
+        generate_plate_by_type(load_keyboard(path), plate_type)
+        for path in FLAGS.input for plate_type in FLAGS.plate_type
+    ]
+
+    panel = panelize(plates,
+                     FLAGS.sheet_width,
+                     FLAGS.sheet_height,
+                     kerf=FLAGS.kerf,
+                     margin=FLAGS.margin)
+    logging.info("packed %d plates, sheet utilization %.1f%%", len(plates),
+                 100 * panel.utilization)
+
+    write_polygons_dxf(panel.parts, FLAGS.output, FLAGS.dxf_format)
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -3,20 +3,33 @@
 from absl import app, flags
 
 from kbtb.keyboard import load_keyboard
-from kbtb.qmk import make_qmk_info_file
+from kbtb.qmk import make_qmk_files
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('input', '', 'Input path.')
 flags.DEFINE_string('output', '', 'Output path.')
-flags.DEFINE_enum('format', 'qmk', ['qmk'], 'Type of output to generate.')
+flags.DEFINE_enum('format', 'qmk', ['qmk', 'config', 'keymap'],
+                  'Type of output to generate: info.json, config.h or a '
+                  'default keymap.c.')
+flags.DEFINE_enum('topology', 'order', ['order', 'geometry'],
+                  'How to order keys in layouts without a layout_sequence.')
 
 
 def main(argv):
     kb = load_keyboard(FLAGS.input)
 
+    files = make_qmk_files(kb, topology=FLAGS.topology)
     if FLAGS.format == 'qmk':
         with open(FLAGS.output, 'w') as output:
-            output.write(make_qmk_info_file(kb))
+            output.write(files.info_json)
+
+    elif FLAGS.format == 'config':
+        with open(FLAGS.output, 'w') as output:
+            output.write(files.config_h)
+
+    elif FLAGS.format == 'keymap':
+        with open(FLAGS.output, 'w') as output:
+            output.write(files.keymap_c)
 
     else:
         raise ValueError("unknown --format value")
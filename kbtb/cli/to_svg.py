@@ -3,20 +3,30 @@
 from absl import app, flags
 
 from kbtb.keyboard import load_keyboard
-from kbtb.svg import keyboard_to_layout_svg, svg_to_file
+from kbtb.svg import write_catalog_svg, write_layout_svg
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('input', '', 'Input path.')
 flags.DEFINE_string('output', '', 'Output path.')
-flags.DEFINE_enum('format', 'svg', ['svg'], 'Type of output to generate.')
+flags.DEFINE_enum('format', 'svg', ['svg', 'catalog'],
+                  'Type of output to generate.')
+flags.DEFINE_integer('precision', 3, 'Decimal places for coordinates.')
+flags.DEFINE_list('catalog', [], 'Input paths for --format=catalog.')
+flags.DEFINE_integer('columns', 8, 'Keyboards per row for --format=catalog.')
+flags.DEFINE_float('detail', 0.5,
+                   'Simplification tolerance for --format=catalog.')
 
 
 def main(argv):
-    kb = load_keyboard(FLAGS.input)
-
     if FLAGS.format == 'svg':
+        kb = load_keyboard(FLAGS.input)
+        write_layout_svg(kb, FLAGS.output, precision=FLAGS.precision)
+    elif FLAGS.format == 'catalog':
         with open(FLAGS.output, 'wb') as output:
-            output.write(svg_to_file(keyboard_to_layout_svg(kb)))
+            write_catalog_svg((load_keyboard(path) for path in FLAGS.catalog),
+                              output,
+                              columns=FLAGS.columns,
+                              detail=FLAGS.detail)
     else:
         raise ValueError("unknown --format value")
 
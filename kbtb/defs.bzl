@@ -139,3 +139,54 @@ build_keyboard = rule(
         "kle": "%{name}-kle.json",
     },
 )
+
+def _build_keyboard_combined(ctx):
+    outputs = {
+        "plate_top_dxf": ctx.outputs.plate_top,
+        "plate_bottom_dxf": ctx.outputs.plate_bottom,
+        "svg": ctx.outputs.svg,
+        "kicad_pcb": ctx.outputs.kicad_pcb,
+        "plate_top_pcb": ctx.outputs.plate_top_pcb,
+        "plate_bottom_pcb": ctx.outputs.plate_bottom_pcb,
+        "qmk": ctx.outputs.qmk_header,
+        "kle": ctx.outputs.kle,
+    }
+    ctx.actions.run(
+        inputs = [ctx.file.src],
+        outputs = outputs.values(),
+        arguments = ["--input={}".format(ctx.file.src.path)] + [
+            "--{}={}".format(flag, output.path)
+            for flag, output in outputs.items()
+        ],
+        env = {"LD_LIBRARY_PATH": ctx.executable._build_all.path + ".runfiles/com_gitlab_kicad_kicad"},
+        executable = ctx.executable._build_all,
+    )
+
+    return [DefaultInfo(files = depset([ctx.outputs.svg]))]
+
+# Same outputs as build_keyboard, generated by a single action that
+# loads the keyboard once and shares plates between artifacts.
+build_keyboard_combined = rule(
+    implementation = _build_keyboard_combined,
+    attrs = {
+        "src": attr.label(
+            allow_single_file = [".pb"],
+            mandatory = True,
+        ),
+        "_build_all": attr.label(
+            default = Label("//kbtb/cli:build_all"),
+            executable = True,
+            cfg = "exec",
+        ),
+    },
+    outputs = {
+        "svg": "%{name}.svg",
+        "plate_bottom": "%{name}_plate_bottom.dxf",
+        "plate_top": "%{name}_plate_top.dxf",
+        "kicad_pcb": "%{name}.kicad_pcb",
+        "plate_top_pcb": "%{name}_plate_top.kicad_pcb",
+        "plate_bottom_pcb": "%{name}_plate_bottom.kicad_pcb",
+        "qmk_header": "%{name}-info.json",
+        "kle": "%{name}-kle.json",
+    },
+)
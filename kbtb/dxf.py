@@ -1,21 +1,90 @@
 """Tools for working with dxf (vector CAD) files."""
 
-import ezdxf
+import contextlib
 import io
 
+import ezdxf
+
+
+@contextlib.contextmanager
+def _fixed_meta_data(enabled):
+    # Fix timestamps and GUIDs so identical geometry gives identical bytes.
+    # ezdxf only offers this as a global option, so it is restored after
+    # each write and left alone unless reproducible output is requested.
+    if not enabled:
+        yield
+        return
+    previous = ezdxf.options.write_fixed_meta_data_for_testing
+    ezdxf.options.write_fixed_meta_data_for_testing = True
+    try:
+        yield
+    finally:
+        ezdxf.options.write_fixed_meta_data_for_testing = previous
 
-def polygon_to_dxf_file(geom):
-    """Build a .dxf file containing a single Shapely polygon."""
+
+def polygons_to_dxf_document(geoms):
+    """Build an ezdxf document containing Shapely polygons."""
     doc = ezdxf.new()
     doc.header['$INSUNITS'] = 4  # Milimeters
     doc.header['$AUNITS'] = 0  # Degrees
     doc.header['$MEASUREMENT'] = 1  # Measurement Metric
 
     msp = doc.modelspace()
-    msp.add_lwpolyline(geom.exterior.coords)
-    for interior in geom.interiors:
-        msp.add_lwpolyline(interior.coords)
+    for geom in geoms:
+        msp.add_lwpolyline(geom.exterior.coords)
+        for interior in geom.interiors:
+            msp.add_lwpolyline(interior.coords)
+    return doc
+
+
+def polygon_to_dxf_document(geom):
+    """Build an ezdxf document containing a single Shapely polygon."""
+    return polygons_to_dxf_document([geom])
+
+
+def write_dxf(doc, output, fmt="asc"):
+    """Write an ezdxf document to a path or binary file object.
+
+    fmt is "asc" for text DXF or "bin" for the smaller binary DXF. Text
+    output is encoded while it is written rather than built up as a
+    string first.
+    """
+    if isinstance(output, (str, bytes, bytearray)) or hasattr(
+            output, '__fspath__'):
+        with open(output, 'wb') as fp:
+            write_dxf(doc, fp, fmt)
+    elif fmt == "bin":
+        doc.write(output, fmt="bin")
+    elif fmt == "asc":
+        text = io.TextIOWrapper(output,
+                                encoding=doc.output_encoding,
+                                errors="dxfreplace",
+                                newline="")
+        doc.write(text, fmt="asc")
+        text.flush()
+        text.detach()
+    else:
+        raise RuntimeError(f"unknown dxf format: {fmt}")
+
+
+def write_polygon_dxf(geom, output, fmt="asc", reproducible=False):
+    """Stream a .dxf file containing a single Shapely polygon to output."""
+    with _fixed_meta_data(reproducible):
+        write_dxf(polygon_to_dxf_document(geom), output, fmt)
+
+
+def write_polygons_dxf(geoms, output, fmt="asc", reproducible=False):
+    """Stream a .dxf file containing many Shapely polygons to output."""
+    with _fixed_meta_data(reproducible):
+        write_dxf(polygons_to_dxf_document(geoms), output, fmt)
+
+
+def polygon_to_dxf_file(geom, reproducible=False, fmt="asc"):
+    """Build a .dxf file containing a single Shapely polygon.
 
-    fn = io.StringIO()
-    doc.write(fn, fmt="asc")
-    return fn.getvalue().encode('utf-8')
+    With reproducible set, timestamps and GUIDs are fixed so identical
+    geometry always produces identical bytes.
+    """
+    fn = io.BytesIO()
+    write_polygon_dxf(geom, fn, fmt, reproducible)
+    return fn.getvalue()
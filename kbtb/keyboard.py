@@ -1,6 +1,8 @@
 """Helpers for working with keyboard.proto data."""
 
 import sys
+
+import numpy as np
 from google.protobuf import text_format
 
 from kbtb.keyboard_pb2 import Keyboard
@@ -28,3 +30,81 @@ def load_keyboard(input_path):
         kb = Keyboard()
         kb.ParseFromString(fn.read())
         return kb
+
+
+class KeyArray:
+    """A columnar view of a keyboard's keys.
+
+    Holds one NumPy array per key field so hot loops can work on whole
+    columns instead of reading protobuf attributes key by key. Build it
+    once with from_keys, modify the arrays, then write_to a Keyboard.
+    """
+
+    FIELDS = {
+        "x": float,
+        "y": float,
+        "r": float,
+        "unit_width": float,
+        "unit_height": float,
+        "controller_pin_low": int,
+        "controller_pin_high": int,
+        "has_stabilizer": bool,
+        "stabilizer_size": float,
+        "stabilizer_r": float,
+        "switch_r": float,
+    }
+
+    def __init__(self, x, y, r=0, unit_width=1, unit_height=1, **fields):
+        n = len(x)
+        values = dict(x=x, y=y, r=r, unit_width=unit_width,
+                      unit_height=unit_height, **fields)
+        for name, dtype in self.FIELDS.items():
+            value = np.zeros(n, dtype=dtype)
+            value[:] = values.pop(name, 0)
+            setattr(self, name, value)
+        if values:
+            raise TypeError(f"unknown key fields: {sorted(values)}")
+
+    def __len__(self):
+        return len(self.x)
+
+    @classmethod
+    def from_keys(cls, keys):
+        keys = list(keys)
+        return cls(
+            x=[k.pose.x for k in keys],
+            y=[k.pose.y for k in keys],
+            r=[k.pose.r for k in keys],
+            unit_width=[k.unit_width for k in keys],
+            unit_height=[k.unit_height for k in keys],
+            controller_pin_low=[k.controller_pin_low for k in keys],
+            controller_pin_high=[k.controller_pin_high for k in keys],
+            has_stabilizer=[k.HasField("stabilizer") for k in keys],
+            stabilizer_size=[k.stabilizer.size for k in keys],
+            stabilizer_r=[k.stabilizer.r for k in keys],
+            switch_r=[k.switch_r for k in keys],
+        )
+
+    @classmethod
+    def from_keyboard(cls, kb):
+        return cls.from_keys(kb.keys)
+
+    def write_to(self, kb):
+        """Replace the keys of kb with the contents of this array."""
+        del kb.keys[len(self):]
+        while len(kb.keys) < len(self):
+            kb.keys.add()
+
+        columns = zip(*(getattr(self, name).tolist() for name in self.FIELDS))
+        for key, (x, y, r, w, h, low, high, has_stab, stab_size, stab_r,
+                  switch_r) in zip(kb.keys, columns):
+            key.pose.x, key.pose.y, key.pose.r = x, y, r
+            key.unit_width, key.unit_height = w, h
+            key.controller_pin_low = low
+            key.controller_pin_high = high
+            if has_stab:
+                key.stabilizer.size, key.stabilizer.r = stab_size, stab_r
+            else:
+                key.ClearField("stabilizer")
+            key.switch_r = switch_r
+        return kb
@@ -18,10 +18,15 @@ https://github.com/ijprest/kle-serial/blob/master/index.ts
 
 import io
 import json
+import multiprocessing
+import os
 from math import sin, cos, radians, isclose
 
+import numpy as np
+
+from kbtb.keyboard import KeyArray
 from kbtb.keyboard_pb2 import Keyboard
-from kbtb.layout import group_by_row, generate_placeholders
+from kbtb.layout import key_bounds, key_topology
 from kbtb.outline import generate_outline_tight, generate_outline_convex_hull, generate_outline_rectangle
 from kbtb.matrix import fill_matrix_rows
 
@@ -49,8 +54,8 @@ def kle_position(key, keyboard_unit=19.05, x0=0, y0=0):
             key.unit_height)
 
 
-def keyboard_to_kle(kb, keyboard_unit=19.05):
-    x_min, y_min, x_max, y_max = generate_placeholders(kb.keys).bounds
+def keyboard_to_kle(kb, keyboard_unit=19.05, topology="order"):
+    x_min, y_min, x_max, y_max = key_bounds(kb.keys, keyboard_unit)
 
     kle_metadata = {
         "name": kb.name,
@@ -63,10 +68,10 @@ def keyboard_to_kle(kb, keyboard_unit=19.05):
     # state for KLE's relative positioning
     current_x, current_y, current_r = 0, 0, 0
 
-    for row in group_by_row(kb.keys):
+    for row in key_topology(kb.keys, method=topology).rows:
         kle_row = []
 
-        for key in row:
+        for key in (kb.keys[i] for i in row):
             props = {}
 
             x, y, r, w, h = kle_position(
@@ -107,38 +112,37 @@ def keyboard_to_kle(kb, keyboard_unit=19.05):
     return kle_data
 
 
-def keyboard_to_kle_file(kb, keyboard_unit=19.05):
-    kle_data = keyboard_to_kle(kb, keyboard_unit)
+def keyboard_to_kle_file(kb, keyboard_unit=19.05, topology="order"):
+    kle_data = keyboard_to_kle(kb, keyboard_unit, topology)
     return json.dumps(kle_data)
 
 
-def kle_param_to_key(x, y, r, rx, ry, w, h, keyboard_unit=19.05):
-    x = (x) * keyboard_unit
-    y = -(y) * keyboard_unit
-    r = -r
-
-    x2 = x * cos(radians(r)) - y * sin(radians(r))
-    y2 = y * cos(radians(r)) + x * sin(radians(r))
-
-    x2 += rx * keyboard_unit
-    y2 -= ry * keyboard_unit
-
-    height = h * keyboard_unit
-    x2 = x2 + sin(radians(-r - 180)) * height / 2
-    y2 = y2 + cos(radians(-r - 180)) * height / 2
-    width = w * keyboard_unit
-    x2 = x2 - sin(radians(-r - 90)) * width / 2
-    y2 = y2 - cos(radians(-r - 90)) * width / 2
-
-    return Keyboard.Key(
-        pose={
-            "x": x2,
-            "y": y2,
-            "r": r
-        }, unit_width=w, unit_height=h)
+def write_kle_stream(keyboards,
+                     fp,
+                     format='jsonl',
+                     keyboard_unit=19.05,
+                     topology="order"):
+    """Write kle data for many keyboards to a text file object.
+
+    Keyboards are converted and written one at a time so only one
+    layout is held in memory. format is 'jsonl' for one layout per line
+    or 'json' for a single array of layouts.
+    """
+    if format == 'jsonl':
+        for kb in keyboards:
+            json.dump(keyboard_to_kle(kb, keyboard_unit, topology), fp)
+            fp.write("\n")
+    elif format == 'json':
+        fp.write("[")
+        for i, kb in enumerate(keyboards):
+            if i: fp.write(", ")
+            json.dump(keyboard_to_kle(kb, keyboard_unit, topology), fp)
+        fp.write("]")
+    else:
+        raise RuntimeError(f"unknown format: {format}")
 
 
-def add_standard_stabilizers(kb):
+def add_standard_stabilizers(kb, topology="order"):
     allowed_sizes = [2, 6.25]
 
     def add(key, size, r, flip):
@@ -152,33 +156,25 @@ def add_standard_stabilizers(kb):
         if flip:
             key.stabilizer.r += 180
 
-    rows = list(group_by_row(kb.keys))
-    for i, row in enumerate(rows):
-        last_row = i == len(rows) - 1
+    topology = key_topology(kb.keys, method=topology)
+    for i, key in enumerate(kb.keys):
+        last_row = topology.row[i] == len(topology.rows) - 1
+        last_col = topology.right[i] < 0
+        if key.unit_width > 1 and key.unit_height == 1:
+            add(key, key.unit_width, 0, last_row)
+        if key.unit_width == 1 and key.unit_height > 1:
+            add(key, key.unit_height, 90, last_col)
 
-        for j, key in enumerate(row):
-            last_col = j == len(row) - 1
-            if key.unit_width > 1 and key.unit_height == 1:
-                add(key, key.unit_width, 0, last_row)
-            if key.unit_width == 1 and key.unit_height > 1:
-                add(key, key.unit_height, 90, last_col)
 
+def parse_kle(kle_json):
+    """Walk kle rows and collect the parameters of every key.
 
-def kle_to_keyboard(kle_json,
-                    keyboard_unit=19.05,
-                    switch=Keyboard.SWITCH_CHERRY_MX,
-                    controller=Keyboard.CONTROLLER_STM32F072,
-                    outline_type='convex-hull',
-                    hole_diameter=2.4,
-                    add_stabilizers=True,
-                    add_matrix=True,
-                    **kb_args):
-    kb = Keyboard(
-        name="kle-import",
-        controller=controller,
-        switch=switch,
-        hole_diameter=hole_diameter,
-        **kb_args)
+    Returns a dict of the keyboard-level metadata found in the data and
+    an (N, 7) array with one (x, y, r, rx, ry, w, h) row per key, in kle
+    units, ready for kle_params_to_poses.
+    """
+    metadata = {}
+    params = []
 
     # state for KLE's relative positioning
     current_y, current_r, current_rx, current_ry = 0, 0, 0, 0
@@ -197,10 +193,7 @@ def kle_to_keyboard(kle_json,
         })
 
         if isinstance(row_or_metadata, dict):
-            if "name" in row_or_metadata:
-                kb.name = row_or_metadata["name"]
-            if "kb-toolkit-outline" in row_or_metadata:
-                outline_type = row_or_metadata["kb-toolkit-outline"]
+            metadata.update(row_or_metadata)
         else:
             for key_or_props in row_or_metadata:
                 if isinstance(key_or_props, dict):
@@ -220,16 +213,8 @@ def kle_to_keyboard(kle_json,
                     width = props["w"]
                     height = props["h"]
 
-                    kb.keys.append(
-                        kle_param_to_key(
-                            x=current_x,
-                            y=current_y,
-                            r=current_r,
-                            rx=current_rx,
-                            ry=current_ry,
-                            w=width,
-                            h=height,
-                            keyboard_unit=keyboard_unit))
+                    params.append((current_x, current_y, current_r,
+                                   current_rx, current_ry, width, height))
 
                     current_x += width
                     props.update({
@@ -241,8 +226,69 @@ def kle_to_keyboard(kle_json,
 
             current_y += 1
 
+    return metadata, np.array(params, dtype=float).reshape(-1, 7)
+
+
+def kle_params_to_poses(params, keyboard_unit=19.05):
+    """Convert parse_kle parameters to an (N, 3) array of key x, y, r."""
+    x, y, r, rx, ry, w, h = params.T
+
+    x = x * keyboard_unit
+    y = -y * keyboard_unit
+    r = -r + 0.0  # avoid -0.0, which would be serialized as r: -0
+
+    cos_r, sin_r = np.cos(np.radians(r)), np.sin(np.radians(r))
+    x2 = x * cos_r - y * sin_r
+    y2 = y * cos_r + x * sin_r
+
+    x2 += rx * keyboard_unit
+    y2 -= ry * keyboard_unit
+
+    # move from the top-left corner to the center of the key
+    height = h * keyboard_unit
+    x2 = x2 + sin_r * height / 2
+    y2 = y2 - cos_r * height / 2
+    width = w * keyboard_unit
+    x2 = x2 + cos_r * width / 2
+    y2 = y2 + sin_r * width / 2
+
+    return np.stack([x2, y2, r], axis=-1)
+
+
+def kle_to_keyboard(kle_json,
+                    keyboard_unit=19.05,
+                    switch=Keyboard.SWITCH_CHERRY_MX,
+                    controller=Keyboard.CONTROLLER_STM32F072,
+                    outline_type='convex-hull',
+                    hole_diameter=2.4,
+                    add_stabilizers=True,
+                    add_matrix=True,
+                    add_outline=True,
+                    **kb_args):
+    kb = Keyboard(
+        name="kle-import",
+        controller=controller,
+        switch=switch,
+        hole_diameter=hole_diameter,
+        **kb_args)
+
+    metadata, params = parse_kle(kle_json)
+    if "name" in metadata:
+        kb.name = metadata["name"]
+    if "kb-toolkit-outline" in metadata:
+        outline_type = metadata["kb-toolkit-outline"]
+
+    poses = kle_params_to_poses(params, keyboard_unit)
+    for (x, y, r), (w, h) in zip(poses.tolist(), params[:, 5:7].tolist()):
+        kb.keys.add(pose={"x": x, "y": y, "r": r}, unit_width=w, unit_height=h)
+
+    # Stabilizers and the matrix share one topology found from the poses
+    topology = key_topology(KeyArray(*poses.T))
+
     # generate outline polygon
-    if outline_type == 'tight':
+    if not add_outline:
+        pass
+    elif outline_type == 'tight':
         outline = generate_outline_tight(kb)
     elif outline_type == 'convex-hull':
         outline = generate_outline_convex_hull(kb)
@@ -251,13 +297,70 @@ def kle_to_keyboard(kle_json,
     else:
         raise RuntimeError(f"unknown outline type: {outline_type}")
 
-    for x, y in outline.coords:
-        kb.outline_polygon.add(x=x, y=y)
+    if add_outline:
+        for x, y in outline.coords:
+            kb.outline_polygon.add(x=x, y=y)
 
     if add_stabilizers:
-        add_standard_stabilizers(kb)
+        add_standard_stabilizers(kb, topology)
 
     if add_matrix:
-        fill_matrix_rows(kb)
+        fill_matrix_rows(kb, topology)
 
     return kb
+
+
+def _kle_record_to_keyboard(record):
+    name, kle_json, kle_args = record
+    kb = kle_to_keyboard(kle_json, **kle_args)
+    return name, kb.SerializeToString()
+
+
+def iter_kle_records(path):
+    """Yield (name, kle_json) from a directory of .json files or a .jsonl file.
+
+    Each line of a .jsonl file is either bare kle data or an object with
+    "name" and "kle" fields.
+    """
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".json"):
+                with open(os.path.join(path, filename)) as fp:
+                    yield os.path.splitext(filename)[0], json.load(fp)
+    else:
+        with open(path) as fp:
+            for i, line in enumerate(fp):
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if isinstance(record, dict):
+                    yield record.get("name", str(i)), record["kle"]
+                else:
+                    yield str(i), record
+
+
+def import_kle_corpus(path,
+                      processes=None,
+                      add_outline=False,
+                      add_stabilizers=False,
+                      add_matrix=False,
+                      **kle_args):
+    """Import many kle layouts in parallel.
+
+    Yields (name, Keyboard) in input order. Outline, stabilizer and
+    matrix generation are off by default since bulk analysis rarely
+    needs them; any kle_to_keyboard argument can be passed through.
+    """
+    kle_args.update(add_outline=add_outline,
+                    add_stabilizers=add_stabilizers,
+                    add_matrix=add_matrix)
+    records = ((name, kle_json, kle_args)
+               for name, kle_json in iter_kle_records(path))
+
+    with multiprocessing.Pool(processes) as pool:
+        for name, kb_bytes in pool.imap(_kle_record_to_keyboard,
+                                        records,
+                                        chunksize=16):
+            kb = Keyboard()
+            kb.ParseFromString(kb_bytes)
+            yield name, kb
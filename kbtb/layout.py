@@ -1,10 +1,15 @@
 """Helpers to create and modify key arrangments."""
 
-from math import atan, atan2, cos, degrees, radians, sin
+import functools
+from math import acos, atan, atan2, ceil, cos, degrees, pi, radians, sin
+from typing import NamedTuple, Tuple
 
+import numpy as np
 import shapely
+import shapely.affinity
 import shapely.geometry
 
+from kbtb.keyboard import KeyArray
 from kbtb.keyboard_pb2 import Keyboard, Position, Pose
 
 
@@ -16,8 +21,8 @@ def pose(x, y, r=0):
 
 
 def pose_to_xyr(p):
-    return (p[0].x, p[0].y,
-            degrees(atan2(p[1].y - p[0].y, p[1].x - p[0].x)) - 90)
+    p0, p1 = p.geoms
+    return (p0.x, p0.y, degrees(atan2(p1.y - p0.y, p1.x - p0.x)) - 90)
 
 
 def make_key(x, y, r=0, w=1, h=1):
@@ -30,14 +35,64 @@ def make_key(x, y, r=0, w=1, h=1):
     return k
 
 
-def rotate_keys(keys, angle):
-    for key in keys:
-        p = pose(key.pose.x, key.pose.y, key.pose.r)
-        p = shapely.affinity.rotate(p, angle / 2, origin=(0, 0))
-        x, y, r = pose_to_xyr(p)
+def key_poses(keys):
+    """Poses of keys as an (N, 3) array of x, y, r."""
+    if not isinstance(keys, KeyArray):
+        keys = KeyArray.from_keys(keys)
+    return np.stack([keys.x, keys.y, keys.r], axis=-1)
+
+
+def normalize_rotation(r):
+    """Wrap rotations in degrees into the (-270, 90] range used by poses."""
+    theta = np.radians(np.asarray(r, dtype=float) + 90)
+    return np.degrees(np.arctan2(np.sin(theta), np.cos(theta))) - 90
+
+
+def rotate_poses(poses, angle, origin=(0, 0), use_radians=False):
+    """Rotate an (N, 3) array of poses counterclockwise about origin.
+
+    angle may be a scalar or an array with one angle per pose.
+    """
+    poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+    angle = np.asarray(angle, dtype=float)
+    theta = angle if use_radians else np.radians(angle)
+    c, s = np.cos(theta), np.sin(theta)
+    ox, oy = np.asarray(origin[0]), np.asarray(origin[1])
+    dx, dy = poses[:, 0] - ox, poses[:, 1] - oy
+    return np.stack([
+        ox + dx * c - dy * s,
+        oy + dx * s + dy * c,
+        normalize_rotation(poses[:, 2] + np.degrees(theta)),
+    ], axis=-1)
+
+
+def translate_poses(poses, xoff=0, yoff=0):
+    poses = np.array(poses, dtype=float).reshape(-1, 3)
+    poses[:, 0] += xoff
+    poses[:, 1] += yoff
+    return poses
+
+
+def mirror_poses(poses, x=0):
+    """Mirror an (N, 3) array of poses across the vertical line at x."""
+    poses = np.asarray(poses, dtype=float).reshape(-1, 3)
+    return np.stack([
+        2 * x - poses[:, 0],
+        poses[:, 1],
+        normalize_rotation(-poses[:, 2]),
+    ], axis=-1)
+
+
+def poses_to_keys(poses):
+    for x, y, r in np.asarray(poses).tolist():
         yield make_key(x, y, r)
 
 
+def rotate_keys(keys, angle):
+    poses = rotate_poses(key_poses(keys), angle / 2)
+    yield from poses_to_keys(poses)
+
+
 def between(k1, k2):
     return Position(x=(k1.x + k2.x) / 2, y=(k1.y + k2.y) / 2)
 
@@ -89,52 +144,344 @@ def project_to_outline(outline, point, offset=0, flip=False):
         r=180 + degrees(atan2(ps[2].y - ps[0].y, ps[2].x - ps[0].x)))
 
 
-def group_by_row(keys):  # duplicated to matrix.py
+class KeyTopology(NamedTuple):
+    """Row and column structure of a list of keys.
+
+    Arrays are indexed by key and are read-only since they are shared
+    between every caller asking about the same keys. Missing neighbors
+    are -1.
+    """
+    rows: Tuple[np.ndarray, ...]  # key indices of each row, left to right
+    row: np.ndarray  # row id of each key, top to bottom
+    col: np.ndarray  # column id of each key
+    left: np.ndarray
+    right: np.ndarray
+    up: np.ndarray  # key with the same column id in the previous row
+    down: np.ndarray
+    rank: np.ndarray  # position of each key in row-major order
+
+
+def _read_only(*arrays):
+    for a in arrays:
+        a.flags.writeable = False
+    return arrays
+
+
+def _build_topology(row, order, col=None):
+    """Link keys given their row ids and row-major order.
+
+    Column ids default to the position of each key within its row.
+    """
+    n = len(row)
+    if not n:
+        return KeyTopology((), *_read_only(*(np.zeros(0, dtype=int)
+                                              for _ in range(7))))
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n)
+    row = np.asarray(row, dtype=int)
+
+    starts = np.flatnonzero(np.diff(row[order], prepend=-1))
+    if col is None:
+        col = rank - rank[order[starts]][row]
+    col = np.asarray(col, dtype=int)
+
+    same = row[order[1:]] == row[order[:-1]]
+    left = np.full(n, -1)
+    right = np.full(n, -1)
+    left[order[1:][same]] = order[:-1][same]
+    right[order[:-1][same]] = order[1:][same]
+
+    # find the key at (row -/+ 1, col) by searching the sorted cell ids
+    width = col.max() + 1
+    cell = row * width + col
+    by_cell = np.argsort(cell, kind="stable")
+
+    def find(target, valid):
+        found = by_cell[np.minimum(np.searchsorted(cell[by_cell], target),
+                                   n - 1)]
+        return np.where(valid & (cell[found] == target), found, -1)
+
+    up = find(cell - width, row > 0)
+    down = find(cell + width, row < row.max())
+
+    rows = _read_only(*np.split(order, starts[1:]))
+    return KeyTopology(rows, *_read_only(row, col, left, right, up, down,
+                                         rank))
+
+
+@functools.lru_cache(maxsize=64)
+def _order_topology(xs):
+    x = np.frombuffer(xs)
+
+    # a new row starts whenever a key is left of the one before it
+    row = np.cumsum(np.diff(x, prepend=-np.inf) < 0)
+    return _build_topology(row, np.arange(len(x)))
+
+
+def cluster_1d(values, gap):
+    """Label values so that sorted neighbours closer than gap share a label.
+
+    Labels count up from the smallest value. Returns the labels and the
+    widest span of values covered by any one label.
+    """
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(values, kind="stable")
+    labels = np.empty(len(values), dtype=int)
+    labels[order] = np.cumsum(
+        np.concatenate([[0], np.diff(values[order]) > gap]))
+
+    spread = 0.0
+    if len(values):
+        lo = np.full(labels.max() + 1, np.inf)
+        hi = np.full(labels.max() + 1, -np.inf)
+        np.minimum.at(lo, labels, values)
+        np.maximum.at(hi, labels, values)
+        spread = float((hi - lo).max())
+    return labels, spread
+
+
+@functools.lru_cache(maxsize=64)
+def _geometry_topology(xyr, gap):
+    x, y, r = np.frombuffer(xyr).reshape(3, -1)
+
+    # position of each key along and across its own rotated frame
+    theta = np.radians(r)
+    u = x * np.cos(theta) + y * np.sin(theta)
+    v = y * np.cos(theta) - x * np.sin(theta)
+
+    row, row_spread = cluster_1d(-v, gap)
+    col, col_spread = cluster_1d(u, gap)
+
+    if row_spread <= col_spread:
+        # rows line up (row stagger or ortholinear); order keys along them
+        order = np.lexsort((u, row))
+        return _build_topology(row, order,
+                               col if col_spread <= gap else None)
+
+    # columns line up (column stagger); walk down from the top putting
+    # each key below the keys over it in its own and adjacent columns
+    # that are more than the largest expected stagger higher
+    order = np.lexsort((-v, col))
+    starts = np.searchsorted(col[order], np.arange(col.max() + 2))
+    heights = [-v[order[a:b]] for a, b in zip(starts[:-1], starts[1:])]
+    stagger = 1.5 * gap
+
+    row = np.zeros(len(x), dtype=int)
+    for i in np.argsort(-v, kind="stable"):
+        c = col[i]
+        for d in (c - 1, c, c + 1):
+            if 0 <= d < len(heights):
+                limit = -v[i] - (stagger if d != c else 0)
+                above = np.searchsorted(heights[d], limit)
+                if above:
+                    row[i] = max(row[i], row[order[starts[d] + above - 1]] + 1)
+    return _build_topology(row, np.lexsort((u, row)),
+                           _fold_columns(row, col, u))
+
+
+def _fold_columns(row, col, u):
+    """Move keys out of columns that no other row uses.
+
+    Thumb clusters are rotated away from the columns above them, so
+    their keys tend to form columns of their own that waste matrix
+    pins. Every row using such a column has its keys matched, in order
+    along the row, to the columns shared by several rows, keeping the
+    total distance between each key and its column's center smallest.
+    Rows with more keys than there are shared columns are left alone.
+    """
+    cells = np.unique(np.stack([col, row]), axis=1)
+    shared = np.flatnonzero(np.bincount(cells[0]) > 1)
+    lonely = np.setdiff1d(col, shared)
+    if not len(lonely) or not len(shared):
+        return col
+
+    centers = np.array([u[col == c].mean() for c in shared])
+    col = col.copy()
+    for r in np.unique(row[np.isin(col, lonely)]):
+        keys = np.flatnonzero(row == r)
+        keys = keys[np.argsort(u[keys], kind="stable")]
+        k, m = len(keys), len(shared)
+        if k > m:
+            continue
+
+        # cost[i, j] is the cheapest way to place the first i keys in
+        # the first j columns; each key moves right of the one before
+        distance = np.abs(u[keys][:, None] - centers[None, :])
+        cost = np.full((k + 1, m + 1), np.inf)
+        cost[0] = 0
+        for i in range(1, k + 1):
+            for j in range(i, m + 1):
+                cost[i, j] = min(cost[i, j - 1],
+                                 cost[i - 1, j - 1] + distance[i - 1, j - 1])
+
+        j = m
+        for i in range(k, 0, -1):
+            while cost[i, j] == cost[i, j - 1]:
+                j -= 1
+            col[keys[i - 1]] = shared[j - 1]
+            j -= 1
+
+    return np.unique(col, return_inverse=True)[1]
+
+
+def key_topology(keys, method="order", keyboard_unit=19.05, tolerance=0.5):
+    """Find the rows and columns of a list of keys.
+
+    With the "order" method a new row starts whenever one key is
+    positioned to the left of the one before it, so keys must have
+    been added row by row from left to right.
+
+    The "geometry" method ignores the order of the keys. Each key's
+    center is projected into its own rotated frame, which puts the
+    two mirrored halves of a split keyboard on the same rows, and the
+    projections are clustered wherever neighbours are more than
+    tolerance units apart. Whichever of rows or columns cluster
+    tightly is kept and the other is counted along it, so both row
+    and column staggered layouts work. Rotated thumb clusters that
+    would form columns of their own are folded into the nearest shared
+    columns.
+
+    The result only depends on the key positions, so it is computed
+    once and shared until a key is moved, added or removed. keys may
+    be a KeyArray or any iterable of Keyboard.Key messages, of which
+    only the poses are read. Callers that already hold a KeyTopology
+    can pass it as method to have it returned as is.
+    """
+    if isinstance(method, KeyTopology):
+        return method
+
+    if method == "order":
+        x = keys.x if isinstance(keys, KeyArray) else [k.pose.x for k in keys]
+        return _order_topology(
+            np.ascontiguousarray(x, dtype=float).tobytes())
+    elif method == "geometry":
+        if isinstance(keys, KeyArray):
+            xyr = np.stack([keys.x, keys.y, keys.r])
+        else:
+            xyr = np.array([(k.pose.x, k.pose.y, k.pose.r) for k in keys],
+                           dtype=float).reshape(-1, 3).T
+        return _geometry_topology(
+            xyr.astype(float).tobytes(), tolerance * keyboard_unit)
+    else:
+        raise RuntimeError(f"unknown topology method: {method}")
+
+
+def group_by_row(keys):
     """Split the keys into monotonically increasing sublists of x-position."""
-    row = []
-    last_x = None
-    for key in keys:
-        if last_x and key.pose.x < last_x:
-            yield row
-            row = []
-        last_x = key.pose.x
-        row.append(key)
-    if len(row) > 0: yield row
+    keys = list(keys)
+    for row in key_topology(keys).rows:
+        yield [keys[i] for i in row]
+
+
+def rect_corners(x, y, r, unit_width, unit_height, keyboard_unit=19.05):
+    """Corners of rotated key rectangles as an (N, 4, 2) array.
+
+    Takes arrays of key centers, rotations in degrees and sizes in
+    keyboard units. Corners are in the same order and rotated the same
+    way as the polygons from generate_placeholders.
+    """
+    x, y, r, unit_width, unit_height = np.broadcast_arrays(
+        *(np.asarray(v, dtype=float)
+          for v in (x, y, r, unit_width, unit_height)))
+    w = keyboard_unit * unit_width / 2
+    h = keyboard_unit * unit_height / 2
+    local = np.stack([
+        np.stack([w, h], axis=-1),
+        np.stack([w, -h], axis=-1),
+        np.stack([-w, -h], axis=-1),
+        np.stack([-w, h], axis=-1),
+    ], axis=-2)
+
+    # match shapely.affinity.rotate, which snaps tiny terms to zero
+    theta = r * np.pi / 180.0
+    c, s = np.cos(theta), np.sin(theta)
+    c = np.where(np.abs(c) < 2.5e-16, 0.0, c)[:, None]
+    s = np.where(np.abs(s) < 2.5e-16, 0.0, s)[:, None]
+    return np.stack([
+        (c * local[..., 0] - s * local[..., 1]) + x[:, None],
+        (s * local[..., 0] + c * local[..., 1]) + y[:, None],
+    ], axis=-1)
+
+
+def key_corners(keys, keyboard_unit=19.05):
+    """Corners of each key's placeholder rectangle as an (N, 4, 2) array.
+
+    keys may be a KeyArray or any iterable of Keyboard.Key messages.
+    """
+    if not isinstance(keys, KeyArray):
+        keys = KeyArray.from_keys(keys)
+    return rect_corners(keys.x,
+                        keys.y,
+                        keys.r,
+                        keys.unit_width,
+                        keys.unit_height,
+                        keyboard_unit=keyboard_unit)
+
+
+def key_bounds(keys, keyboard_unit=19.05):
+    """Bounds of the key placeholders without building any geometry.
+
+    Returns the same (x_min, y_min, x_max, y_max) tuple as
+    generate_placeholders(keys).bounds.
+    """
+    corners = key_corners(keys, keyboard_unit).reshape(-1, 2)
+    if not len(corners):
+        return (float("inf"), float("inf"), float("-inf"), float("-inf"))
+    x_min, y_min = corners.min(axis=0).tolist()
+    x_max, y_max = corners.max(axis=0).tolist()
+    return x_min, y_min, x_max, y_max
 
 
 def generate_placeholders(keys, keyboard_unit=19.05):
-    def placeholder(key):
-        width = keyboard_unit * key.unit_width
-        height = keyboard_unit * key.unit_height
-        p = shapely.geometry.polygon.Polygon([
-            (width / 2, height / 2),
-            (width / 2, -height / 2),
-            (-width / 2, -height / 2),
-            (-width / 2, height / 2),
-        ])
-        x, y, r = key.pose.x, key.pose.y, key.pose.r
-        return shapely.affinity.translate(shapely.affinity.rotate(p, r), x, y)
-
-    return shapely.geometry.multipolygon.MultiPolygon(
-        placeholder(key) for key in keys)
+    return shapely.multipolygons(
+        shapely.polygons(key_corners(keys, keyboard_unit)))
 
 
 def mirror_keys(keys, middle_space=0, only_flip=False):
     keys = list(keys)
-    x_min, y_min, _, _ = generate_placeholders(keys).bounds
-
-    row = []
-    for row in group_by_row(keys):
-        full_row = []
-        for key in row:
-            p = pose(key.pose.x, key.pose.y, key.pose.r)
-            p = shapely.affinity.translate(
-                p, xoff=-x_min + middle_space / 2, yoff=-y_min)
-            p2 = shapely.affinity.scale(p, -1, origin=(0, 0))
-            full_row.insert(0, make_key(*pose_to_xyr(p2)))
-            if not only_flip: full_row.append(make_key(*pose_to_xyr(p)))
+    x_min, y_min, _, _ = key_bounds(keys)
+
+    poses = translate_poses(key_poses(keys),
+                            xoff=-x_min + middle_space / 2,
+                            yoff=-y_min)
+    poses[:, 2] = normalize_rotation(poses[:, 2])
+    mirrored = mirror_poses(poses)
+
+    for row in key_topology(keys).rows:
+        yield from poses_to_keys(mirrored[row[::-1]])
+        if not only_flip: yield from poses_to_keys(poses[row])
+
+
+def grid_poses(cols,
+               rows=0,
+               arc_radius=0,
+               x_offset=0,
+               y_offset=0,
+               pitch=19.05,
+               arc_base_row=0,
+               arc_base_col=2):
+    """Vectorized grid, returning an (N, 3) array of poses.
+
+    cols and rows are broadcast against each other, so a whole grid or
+    a single row of keys can be placed in one call.
+    """
+    cols, rows = np.broadcast_arrays(np.asarray(cols, dtype=float),
+                                     np.asarray(rows, dtype=float))
+    cols, rows = cols.ravel(), rows.ravel()
+    y = rows * pitch + y_offset
+    if arc_radius == 0:
+        return np.stack([cols * pitch + x_offset, y, np.zeros_like(y)],
+                        axis=-1)
 
-        yield from full_row
+    # Keys in the arc start at the base column and swing about a point
+    # below the row by an angle proportional to their column offset
+    x = np.full_like(y, arc_base_col * pitch + x_offset)
+    about_y = y - pitch / 2 - arc_radius - (rows - arc_base_row) * pitch
+    theta = (arc_base_col - cols) * 2 * atan(pitch / 2 / arc_radius)
+    return rotate_poses(np.stack([x, y, np.zeros_like(y)], axis=-1),
+                        theta,
+                        origin=(x, about_y),
+                        use_radians=True)
 
 
 def grid(col,
@@ -145,27 +492,41 @@ def grid(col,
          pitch=19.05,
          arc_base_row=0,
          arc_base_col=2):
-    if arc_radius == 0:
-        return make_key(col * pitch + x_offset, row * pitch + y_offset)
-    else:
-        n = arc_base_col - col
-        geom = pose(arc_base_col * pitch + x_offset, row * pitch + y_offset)
-        about = shapely.affinity.translate(
-            geom[0],
-            yoff=-pitch / 2 - arc_radius - (row - arc_base_row) * pitch)
-        geom = shapely.affinity.rotate(
-            geom,
-            n * 2 * atan(pitch / 2 / arc_radius),
-            use_radians=True,
-            origin=about)
-
-        x, y, r = pose_to_xyr(geom)
-        return make_key(x, y, r)
-
-
-def shapely_round(shape, radius_convex, radius_concave, resolution=64):
-    shape = shape.buffer(radius_concave, resolution=resolution)
-    shape = shape.buffer(
-        -radius_concave - radius_convex, resolution=resolution)
-    shape = shape.buffer(radius_convex, resolution=resolution)
+    poses = grid_poses(col, row, arc_radius, x_offset, y_offset, pitch,
+                       arc_base_row, arc_base_col)
+    return next(poses_to_keys(poses))
+
+
+def arc_resolution(radius, tolerance):
+    """Segments per quarter circle keeping chords within tolerance.
+
+    tolerance is the maximum distance in mm between an arc and the
+    straight segments approximating it and must be positive.
+    """
+    if not tolerance > 0:
+        raise ValueError(f"arc tolerance must be positive, got {tolerance}")
+    radius = abs(radius)
+    if radius <= tolerance:
+        return 1
+    return max(1, ceil((pi / 2) / (2 * acos(1 - tolerance / radius))))
+
+
+def shapely_round(shape,
+                  radius_convex,
+                  radius_concave,
+                  resolution=64,
+                  tolerance=None):
+    """Round the convex and concave corners of a shape.
+
+    When tolerance is set, resolution is ignored and the number of
+    segments for each buffer is derived from its radius instead.
+    """
+    def res(radius):
+        return resolution if tolerance is None else arc_resolution(
+            radius, tolerance)
+
+    shape = shape.buffer(radius_concave, resolution=res(radius_concave))
+    shape = shape.buffer(-radius_concave - radius_convex,
+                         resolution=res(radius_concave + radius_convex))
+    shape = shape.buffer(radius_convex, resolution=res(radius_convex))
     return shape
@@ -1,38 +1,28 @@
 """Generate keyboard matrices for keyboard definitions."""
 
 import itertools
+import math
 import random
+import time
 
+from kbtb.layout import key_topology
+from kbtb.qmk import CONTROLLERS
 
-def group_by_row(keys):  # duplicated from layout.py
-    """Split the keys into monotonically increasing sublists of x-position."""
-    row = []
-    last_x = None
-    for key in keys:
-        if last_x and key.pose.x < last_x:
-            yield row
-            row = []
-        last_x = key.pose.x
-        row.append(key)
-    if len(row) > 0: yield row
 
-
-def fill_matrix_rows(kb):
+def fill_matrix_rows(kb, topology="order"):
     """Generates a basic keyboard matrix for the provided keyboard.
 
     Populate the controller_pin_* fields with a matrix that splits
     rows whenever one key is positioned to the left of the one before
     it. If keys are added in a left-to-right order then this will
-    generate an intuitive matrix.
+    generate an intuitive matrix. Pass topology="geometry" to find
+    rows and columns from key positions instead, or a KeyTopology that
+    was already found for kb.keys, see key_topology.
     """
-    rows = list(group_by_row(kb.keys))
-    row_count = len(rows)
-    col_count = max(len(col) for col in rows)
-
-    for row, keys in enumerate(rows):
-        for col, key in enumerate(keys):
-            key.controller_pin_low = row
-            key.controller_pin_high = len(rows) + col
+    topology = key_topology(kb.keys, method=topology)
+    for key, row, col in zip(kb.keys, topology.row, topology.col):
+        key.controller_pin_low = row
+        key.controller_pin_high = len(topology.rows) + col
 
 
 def fill_matrix_random(kb, io=18):
@@ -48,3 +38,240 @@ def fill_matrix_random(kb, io=18):
         low, high = available.pop(rnd.randrange(len(available)))
         key.controller_pin_low = low
         key.controller_pin_high = high
+
+
+def matrix_shapes(key_count):
+    """List every (rows, cols) matrix shape using the fewest pins.
+
+    Shapes whose last row or column would be empty are skipped since
+    they waste a pin.
+    """
+    if key_count == 0:
+        return [(0, 0)]
+    shapes = [(rows, -(-key_count // rows))
+              for rows in range(1, key_count + 1)]
+    shapes = [(rows, cols) for rows, cols in shapes
+              if (rows - 1) * cols < key_count]
+    fewest = min(rows + cols for rows, cols in shapes)
+    return [shape for shape in shapes if sum(shape) == fewest]
+
+
+def assign_by_position(keys, rows, cols, vertical=False):
+    """Assign keys to a matrix by splitting them into bands.
+
+    Keys are sorted from top to bottom and cut into rows bands of
+    nearly equal size, then each band is sorted left to right to pick
+    columns. With vertical set, keys are instead cut left to right into
+    cols bands that are each sorted top to bottom to pick rows. Returns
+    a (row, col) tuple for each key.
+    """
+    if vertical:
+        bands = cols
+        across = lambda i: (keys[i].pose.x, -keys[i].pose.y)
+        along = lambda i: -keys[i].pose.y
+    else:
+        bands = rows
+        across = lambda i: (-keys[i].pose.y, keys[i].pose.x)
+        along = lambda i: keys[i].pose.x
+
+    order = sorted(range(len(keys)), key=across)
+    size, extra = divmod(len(keys), bands) if bands else (0, 0)
+
+    assignment = [None] * len(keys)
+    start = 0
+    for band in range(bands):
+        end = start + size + (band < extra)
+        for position, i in enumerate(sorted(order[start:end], key=along)):
+            assignment[i] = (position, band) if vertical else (band, position)
+        start = end
+    return assignment
+
+
+def spanning_length(points):
+    """Length of a minimum spanning tree over the points.
+
+    Uses Prim's algorithm, which is quadratic in the number of points
+    but matrix nets rarely have more than a couple dozen members.
+    """
+    if len(points) < 2:
+        return 0.0
+    (x0, y0), rest = points[0], list(points[1:])
+    dist = [math.hypot(x - x0, y - y0) for x, y in rest]
+    total = 0.0
+    while rest:
+        i = min(range(len(dist)), key=dist.__getitem__)
+        total += dist[i]
+        x0, y0 = rest[i]
+        rest[i], dist[i] = rest[-1], dist[-1]
+        rest.pop()
+        dist.pop()
+        for j, (x, y) in enumerate(rest):
+            dist[j] = min(dist[j], math.hypot(x - x0, y - y0))
+    return total
+
+
+def group_nets(pins):
+    """Group key indices by net given a (low, high) pin pair per key."""
+    nets = {}
+    for i, pair in enumerate(pins):
+        for net in pair:
+            nets.setdefault(net, set()).add(i)
+    return nets
+
+
+def nets_wire_length(points, nets):
+    """Estimate the total routing length of nets in milimeters.
+
+    Each net is estimated by a minimum spanning tree over the points of
+    its members. This is the wiring metric used throughout this module.
+    """
+    return sum(
+        spanning_length([points[i] for i in members])
+        for members in nets.values())
+
+
+def matrix_nets(kb):
+    """Group key indices by the matrix net of each controller pin."""
+    return group_nets(
+        (k.controller_pin_low, k.controller_pin_high) for k in kb.keys)
+
+
+def matrix_wire_length(kb):
+    """Estimate the total routing length of the matrix nets in milimeters."""
+    points = [(k.pose.x, k.pose.y) for k in kb.keys]
+    return nets_wire_length(points, matrix_nets(kb))
+
+
+def fill_matrix_balanced(kb, pins=None):
+    """Generates a keyboard matrix using as few controller pins as possible.
+
+    Considers every rows by columns shape that fits the keys in the
+    fewest pins, assigns keys to each by position and keeps the one
+    with the shortest estimated wiring, see nets_wire_length. The pin
+    budget defaults to the number of matrix pins kbtb.qmk names for the
+    keyboard's controller. Raises RuntimeError when the keys cannot fit
+    in the budget.
+
+    Returns the number of rows and columns used.
+    """
+    if pins is None and kb.controller in CONTROLLERS:
+        pins = len(CONTROLLERS[kb.controller].pin_names)
+
+    shapes = matrix_shapes(len(kb.keys))
+    if pins is not None and sum(shapes[0]) > pins:
+        raise RuntimeError(f"{len(kb.keys)} keys need at least "
+                           f"{sum(shapes[0])} matrix pins but only {pins} "
+                           "are available")
+
+    points = [(k.pose.x, k.pose.y) for k in kb.keys]
+    best = None
+    for (rows, cols), vertical in itertools.product(shapes, (False, True)):
+        assignment = assign_by_position(kb.keys, rows, cols, vertical)
+        nets = group_nets((row, rows + col) for row, col in assignment)
+        length = nets_wire_length(points, nets)
+        if best is None or length < best[0]:
+            best = (length, rows, cols, assignment)
+    _, rows, cols, assignment = best
+
+    for key, (row, col) in zip(kb.keys, assignment):
+        key.controller_pin_low = row
+        key.controller_pin_high = rows + col
+    return rows, cols
+
+
+def optimize_matrix(kb, time_budget=1.0, iterations=None, seed=0):
+    """Shorten the estimated matrix wiring by simulated annealing.
+
+    Starts from the keyboard's current assignment and repeatedly moves
+    a key to another cell of the same rows by columns matrix, swapping
+    with the key already there if there is one. The pins in use never
+    change. A move only touches the (at most four) nets of the two
+    cells, so only those spanning trees are recomputed rather than the
+    whole matrix. Each is still quadratic in the size of its net, and
+    nets grow with the number of keys, so moves get slower on larger
+    keyboards.
+
+    Runs for time_budget seconds or the given number of iterations,
+    whichever is first. Returns the estimated wire length before and
+    after.
+    """
+    rnd = random.Random(seed)
+    points = [(k.pose.x, k.pose.y) for k in kb.keys]
+    cell = [(k.controller_pin_low, k.controller_pin_high) for k in kb.keys]
+    if len(set(cell)) != len(cell):
+        raise RuntimeError("controller pin assignments not unique")
+
+    rows = sorted(set(low for low, _ in cell))
+    cols = sorted(set(high for _, high in cell))
+    cells = list(itertools.product(rows, cols))
+    occupant = {c: i for i, c in enumerate(cell)}
+
+    nets = matrix_nets(kb)
+    lengths = {
+        net: spanning_length([points[i] for i in members])
+        for net, members in nets.items()
+    }
+    before = current = sum(lengths.values())
+    best, best_cell = current, list(cell)
+
+    def relocate(i, target):
+        for net, new_net in zip(cell[i], target):
+            if net != new_net:
+                nets[net].discard(i)
+                nets.setdefault(new_net, set()).add(i)
+        cell[i] = target
+
+    def move(a, target):
+        # Move key a to target, swapping with its occupant if any
+        b, source = occupant.get(target), cell[a]
+        relocate(a, target)
+        occupant[target] = a
+        if b is None:
+            del occupant[source]
+        else:
+            relocate(b, source)
+            occupant[source] = b
+
+    # Start at a fraction of the average spanning tree edge so that moves
+    # which lengthen a net by part of a key are still often accepted
+    edges = [lengths[net] / max(len(nets[net]) - 1, 1) for net in nets]
+    temperature = start = 0.3 * sum(edges) / max(len(edges), 1)
+    deadline = time.monotonic() + time_budget
+    step = 0
+    while len(cells) > 1 and (iterations is None or step < iterations):
+        if step % 64 == 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            progress = 1 - remaining / time_budget
+            if iterations is not None:
+                progress = max(progress, step / iterations)
+            temperature = start * (1e-3**progress)
+        step += 1
+
+        a = rnd.randrange(len(cell))
+        target = rnd.choice(cells)
+        source = cell[a]
+        if target == source:
+            continue
+        touched = set(source) | set(target)
+
+        move(a, target)
+        new = {
+            net: spanning_length([points[i] for i in nets[net]])
+            for net in touched
+        }
+        delta = sum(new.values()) - sum(lengths[net] for net in touched)
+        if delta <= 0 or (temperature > 0 and
+                          rnd.random() < math.exp(-delta / temperature)):
+            lengths.update(new)
+            current += delta
+            if current < best - 1e-9:
+                best, best_cell = current, list(cell)
+        else:
+            move(a, source)
+
+    for key, (low, high) in zip(kb.keys, best_cell):
+        key.controller_pin_low = low
+        key.controller_pin_high = high
+    return before, matrix_wire_length(kb)
@@ -7,23 +7,32 @@ from kbtb.layout import generate_placeholders, shapely_round
 def generate_outline_tight(kb,
                            outline_convex=1.5,
                            outline_concave=80,
-                           resolution=64):
+                           resolution=64,
+                           tolerance=None):
     placeholders = generate_placeholders(kb.keys)
     return shapely_round(placeholders,
                          outline_convex,
                          outline_concave,
-                         resolution=resolution).exterior
+                         resolution=resolution,
+                         tolerance=tolerance).exterior
 
 
-def generate_outline_convex_hull(kb, resolution=64, corner_radius=1.5):
+def generate_outline_convex_hull(kb,
+                                 resolution=64,
+                                 corner_radius=1.5,
+                                 tolerance=None):
     placeholders = generate_placeholders(kb.keys)
     return shapely_round(placeholders.convex_hull,
                          corner_radius,
                          corner_radius,
-                         resolution=resolution).exterior
+                         resolution=resolution,
+                         tolerance=tolerance).exterior
 
 
-def generate_outline_rectangle(kb, resolution=64, corner_radius=1.5):
+def generate_outline_rectangle(kb,
+                               resolution=64,
+                               corner_radius=1.5,
+                               tolerance=None):
     placeholders = generate_placeholders(kb.keys)
     if corner_radius == 0:
         return placeholders.envelope.exterior
@@ -31,4 +40,5 @@ def generate_outline_rectangle(kb, resolution=64, corner_radius=1.5):
         return shapely_round(placeholders.envelope,
                              corner_radius,
                              corner_radius,
-                             resolution=resolution).exterior
+                             resolution=resolution,
+                             tolerance=tolerance).exterior
@@ -0,0 +1,129 @@
+"""Pack many plates onto a single sheet for fabrication."""
+
+from typing import List, NamedTuple
+
+import shapely
+import shapely.affinity
+
+
+class Placement(NamedTuple):
+    index: int  # position of the part in the input list
+    x: float  # bottom-left corner of the part's bounding box
+    y: float
+    rotated: bool  # rotated by 90 degrees before placing
+
+
+class Panel(NamedTuple):
+    parts: List[shapely.Geometry]
+    placements: List[Placement]
+    width: float
+    height: float
+    # Area of all parts relative to the area of the sheet
+    utilization: float
+
+
+def pack_skyline(sizes, width, height, allow_rotation=True):
+    """Place rectangles on a sheet using a bottom-left skyline heuristic.
+
+    sizes is a list of (width, height) tuples. Returns a Placement per
+    rectangle in input order, or raises RuntimeError when a rectangle
+    does not fit.
+    """
+    # The skyline is a list of [x, y, width] segments covering the sheet
+    skyline = [[0.0, 0.0, width]]
+    placements = [None] * len(sizes)
+
+    def fit(i, w, h):
+        # Lowest y at which a w-wide rectangle starting at segment i fits
+        x = skyline[i][0]
+        if x + w > width:
+            return None
+        y, j, remaining = 0, i, w
+        while remaining > 1e-9 and j < len(skyline):
+            y = max(y, skyline[j][1])
+            remaining -= skyline[j][2]
+            j += 1
+        return None if y + h > height else y
+
+    order = sorted(range(len(sizes)),
+                   key=lambda i: (-max(sizes[i]) if allow_rotation else
+                                  -sizes[i][1], i))
+    for index in order:
+        w, h = sizes[index]
+        options = [(w, h, False)]
+        if allow_rotation and w != h:
+            options.append((h, w, True))
+
+        best = None
+        for i in range(len(skyline)):
+            for rw, rh, rotated in options:
+                y = fit(i, rw, rh)
+                if y is not None:
+                    score = (y + rh, skyline[i][0])
+                    if best is None or score < best[0]:
+                        best = (score, i, y, rw, rh, rotated)
+        if best is None:
+            raise RuntimeError(f"no room left for part {index} ({w} by {h}) "
+                               f"on a {width} by {height} sheet")
+
+        _, i, y, rw, rh, rotated = best
+        x = skyline[i][0]
+        placements[index] = Placement(index, x, y, rotated)
+
+        # Raise the skyline under the new rectangle
+        new = [x, y + rh, rw]
+        j = i
+        while j < len(skyline) and skyline[j][0] < x + rw:
+            seg_end = skyline[j][0] + skyline[j][2]
+            if seg_end <= x + rw:
+                del skyline[j]
+            else:
+                skyline[j][2] = seg_end - (x + rw)
+                skyline[j][0] = x + rw
+                break
+        skyline.insert(i, new)
+
+        # Merge neighbours at the same height
+        j = max(i - 1, 0)
+        while j < len(skyline) - 1:
+            if skyline[j][1] == skyline[j + 1][1]:
+                skyline[j][2] += skyline[j + 1][2]
+                del skyline[j + 1]
+            else:
+                j += 1
+
+    return placements
+
+
+def panelize(geoms,
+             width,
+             height,
+             kerf=3,
+             margin=5,
+             allow_rotation=True):
+    """Arrange plates on a sheet with kerf spacing between them.
+
+    All dimensions are in milimeters. Returns a Panel with the moved
+    geometry so it can be written with kbtb.dxf.write_polygons_dxf.
+    """
+    geoms = list(geoms)
+    bounds = shapely.bounds(geoms)
+    sizes = [(x_max - x_min + kerf, y_max - y_min + kerf)
+             for x_min, y_min, x_max, y_max in bounds]
+
+    placements = pack_skyline(sizes,
+                              width - 2 * margin + kerf,
+                              height - 2 * margin + kerf,
+                              allow_rotation=allow_rotation)
+
+    parts = []
+    for geom, placement in zip(geoms, placements):
+        if placement.rotated:
+            geom = shapely.affinity.rotate(geom, 90, (0, 0))
+        x_min, y_min, _, _ = geom.bounds
+        parts.append(
+            shapely.affinity.translate(geom, margin + placement.x - x_min,
+                                       margin + placement.y - y_min))
+
+    utilization = sum(g.area for g in geoms) / (width * height)
+    return Panel(parts, placements, width, height, utilization)
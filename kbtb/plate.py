@@ -1,10 +1,17 @@
 """Generate switch mounting plate designs."""
 
+import functools
+
+import numpy as np
 import shapely
+import shapely.affinity
 import shapely.geometry
-import shapely.ops
 
-from kbtb.layout import shapely_round
+from kbtb.keyboard_pb2 import Keyboard
+from kbtb.layout import arc_resolution, shapely_round
+
+# Cutouts in my first waterjet cut Aluminum plate made by SendCutSend were a bit tight, fudging here.
+CUTOUT_PADDING = 0.05
 
 # Polygon describing the shape of an individual key cutout
 cutout_geom_mx = shapely.geometry.polygon.Polygon([
@@ -63,10 +70,6 @@ cutout_geom_alps = shapely.geometry.polygon.Polygon([
 ])
 
 
-def generate_hole_shape(center, diameter):
-    return center.buffer(diameter / 2)
-
-
 def cherry_stabilizer(length):
     offsets_by_size = {
         # adapted from https://github.com/swill/kad/blob/62948e9/key.go
@@ -123,40 +126,298 @@ def cherry_stabilizer(length):
     return stab_path
 
 
-def generate_cherry_cutout(key, corner_radius=0.3, resolution=16, shift=0):
-    x, y, r = key.pose.x, key.pose.y, key.pose.r
+@functools.lru_cache(maxsize=None)
+def cherry_cutout_template(stabilizer_size=None,
+                           stabilizer_r=0,
+                           corner_radius=0.3,
+                           resolution=16,
+                           shift=0,
+                           tolerance=None):
+    """Build a rounded cutout centered on the origin with no rotation.
+
+    Keys that share the same stabilizer and rounding parameters share
+    the same template so the expensive buffering only happens once per
+    distinct key shape.
+    """
     shape = cutout_geom_mx
 
-    if key.HasField("stabilizer"):
-        stab_geom = cherry_stabilizer(key.stabilizer.size)
+    if stabilizer_size is not None:
+        stab_geom = cherry_stabilizer(stabilizer_size)
         if stab_geom:
             shape = shape.union(
-                shapely.affinity.rotate(stab_geom, key.stabilizer.r, (0, 0)))
+                shapely.affinity.rotate(stab_geom, stabilizer_r, (0, 0)))
+
+    if corner_radius == 0 and shift == 0:
+        return shape
+
+    shape = shapely_round(shape,
+                          corner_radius,
+                          corner_radius,
+                          resolution=resolution,
+                          tolerance=tolerance)
+    if tolerance is not None:
+        resolution = arc_resolution(shift, tolerance)
+    return shape.buffer(shift, resolution=resolution)
+
+
+def cutout_template_key(key):
+    """Return the shape parameters that determine a key's cutout."""
+    if key.HasField("stabilizer"):
+        return (key.stabilizer.size, key.stabilizer.r)
+    return (None, 0)
+
+
+def generate_cherry_cutout(key,
+                           corner_radius=0.3,
+                           resolution=16,
+                           shift=0,
+                           tolerance=None):
+    x, y, r = key.pose.x, key.pose.y, key.pose.r
+    shape = cherry_cutout_template(*cutout_template_key(key),
+                                   corner_radius=corner_radius,
+                                   resolution=resolution,
+                                   shift=shift,
+                                   tolerance=tolerance)
 
     shape = shapely.affinity.rotate(shape, r, (0, 0))
-    shape = shapely.affinity.translate(shape, x, y)
+    return shapely.affinity.translate(shape, x, y)
 
-    return shapely_round(
-        shape, corner_radius, corner_radius, resolution=resolution).buffer(
-            shift, resolution=resolution)
 
+def place_cutouts(keys,
+                  corner_radius=0.3,
+                  resolution=16,
+                  shift=0,
+                  tolerance=None):
+    """Generate cutouts for many keys at once.
 
-def generate_plate(kb, padding=0, mounting_holes=False, cutouts=True):
+    Keys are grouped by cutout template and every group is rotated and
+    translated with a single vectorized transform. Returns a geometry
+    array in the same order as keys.
+    """
+    keys = list(keys)
+    cutouts = np.empty(len(keys), dtype=object)
 
-    features = []
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(cutout_template_key(key), []).append(i)
+
+    for template_key, indices in groups.items():
+        template = cherry_cutout_template(*template_key,
+                                          corner_radius=corner_radius,
+                                          resolution=resolution,
+                                          shift=shift,
+                                          tolerance=tolerance)
+        poses = np.array([(keys[i].pose.x, keys[i].pose.y, keys[i].pose.r)
+                          for i in indices])
+        theta = np.radians(poses[:, 2])
+        cos_t, sin_t = np.cos(theta)[:, None], np.sin(theta)[:, None]
+
+        def place(coords):
+            # shapely.transform hands over the coordinates of every
+            # (identical) template in the group stacked in order
+            coords = coords.reshape(len(indices), -1, 2)
+            x, y = coords[..., 0], coords[..., 1]
+            return np.stack([
+                x * cos_t - y * sin_t + poses[:, 0:1],
+                x * sin_t + y * cos_t + poses[:, 1:2],
+            ], axis=-1).reshape(-1, 2)
+
+        cutouts[indices] = shapely.transform(
+            np.full(len(indices), template, dtype=object), place)
+
+    return cutouts
+
+
+def place_holes(positions, diameter, resolution=16, tolerance=None):
+    """Generate circular mounting holes for many positions at once."""
+    if tolerance is not None:
+        resolution = arc_resolution(diameter / 2, tolerance)
+    coords = np.array([(p.x, p.y) for p in positions]).reshape(-1, 2)
+    return shapely.buffer(shapely.points(coords),
+                          diameter / 2,
+                          quad_segs=resolution)
+
+
+def union_intersecting(features):
+    """Union only the features that overlap each other.
+
+    Uses an STRtree to find intersecting pairs and returns one geometry
+    per connected group, so disjoint cutouts are never fed through a
+    global union.
+    """
+    features = np.asarray(features, dtype=object)
+    tree = shapely.STRtree(features)
+    a, b = tree.query(features, predicate="intersects")
+
+    # union-find over the intersecting pairs
+    parent = list(range(len(features)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
 
-    # Cutouts in my first waterjet cut Aluminum plate made by SendCutSend were a bit tight, fudging here.
-    cutout_padding = 0.05
+    for i, j in zip(a, b):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    groups = {}
+    for i in range(len(features)):
+        groups.setdefault(find(i), []).append(i)
+
+    return [
+        features[g[0]] if len(g) == 1 else shapely.union_all(features[g])
+        for g in groups.values()
+    ]
+
+
+def subtract_features(outline, features):
+    """Subtract disjoint features from a simple outline polygon.
+
+    Features strictly inside the outline become interior rings
+    directly; only features touching the boundary go through a boolean
+    difference.
+    """
+    holes, crossing = [], []
+    for feature in union_intersecting(features) if len(features) else []:
+        if (isinstance(feature, shapely.geometry.Polygon)
+                and not feature.interiors
+                and outline.contains_properly(feature)):
+            holes.append(feature.exterior)
+        else:
+            crossing.append(feature)
+
+    plate = shapely.geometry.Polygon(outline.exterior,
+                                     [*outline.interiors, *holes])
+    if crossing:
+        plate = plate.difference(shapely.union_all(crossing))
+    return plate
+
+
+def generate_plate(kb,
+                   padding=0,
+                   mounting_holes=False,
+                   cutouts=True,
+                   method="strtree",
+                   tolerance=None):
+
+    features = []
 
     if cutouts:
-        for key in kb.keys:
-            features.append(generate_cherry_cutout(key, shift=cutout_padding))
+        features.extend(
+            place_cutouts(kb.keys, shift=CUTOUT_PADDING, tolerance=tolerance))
 
     if mounting_holes:
-        for h in kb.hole_positions:
-            center = shapely.geometry.Point(h.x, h.y)
-            features.append(generate_hole_shape(center, kb.hole_diameter))
+        features.extend(
+            place_holes(kb.hole_positions,
+                        kb.hole_diameter,
+                        tolerance=tolerance))
     outline = shapely.geometry.polygon.Polygon(
         (o.x, o.y) for o in kb.outline_polygon)
-    outline = outline.difference(shapely.ops.unary_union(features))
-    return outline
+
+    if method == "strtree":
+        return subtract_features(outline, features)
+    elif method == "union":
+        return outline.difference(shapely.union_all(features))
+    else:
+        raise RuntimeError(f"unknown plate method: {method}")
+
+
+def verify_plate(kb, **plate_args):
+    """Check that the strtree and union plate methods agree."""
+    fast = generate_plate(kb, method="strtree", **plate_args)
+    slow = generate_plate(kb, method="union", **plate_args)
+    return fast.is_valid and shapely.equals(fast, slow)
+
+
+class PlateBuilder:
+    """Regenerate a plate incrementally as a keyboard is edited.
+
+    The builder remembers the last keyboard it saw along with the
+    per-key cutouts and the resulting plate. When only some keys
+    change, the plate is restored and re-cut only inside the region
+    covered by the old and new cutouts of those keys. Any change to
+    the outline or mounting holes triggers a full rebuild.
+    """
+
+    def __init__(self, mounting_holes=False, cutouts=True, tolerance=None):
+        self.mounting_holes = mounting_holes
+        self.cutouts = cutouts
+        self.tolerance = tolerance
+        self.keyboard = None
+        self.key_content = []
+        self.key_cutouts = []
+        self.hole_features = []
+        self.plate = None
+
+    def _frame(self, kb):
+        # Everything except the keys themselves
+        frame = Keyboard(hole_diameter=kb.hole_diameter)
+        frame.outline_polygon.extend(kb.outline_polygon)
+        if self.mounting_holes:
+            frame.hole_positions.extend(kb.hole_positions)
+        return frame.SerializeToString(deterministic=True)
+
+    def _rebuild(self, kb):
+        self.key_cutouts = list(
+            place_cutouts(kb.keys,
+                          shift=CUTOUT_PADDING,
+                          tolerance=self.tolerance)) if self.cutouts else []
+        self.hole_features = list(
+            place_holes(kb.hole_positions,
+                        kb.hole_diameter,
+                        tolerance=self.tolerance)) if self.mounting_holes else []
+        outline = shapely.geometry.polygon.Polygon(
+            (o.x, o.y) for o in kb.outline_polygon)
+        self.plate = subtract_features(outline,
+                                       self.key_cutouts + self.hole_features)
+
+    def update(self, kb):
+        """Return the plate for kb, reusing work from the last update."""
+        content = [k.SerializeToString(deterministic=True) for k in kb.keys]
+
+        if (self.keyboard is None or not self.cutouts
+                or self._frame(kb) != self._frame(self.keyboard)):
+            self._rebuild(kb)
+        else:
+            changed = [
+                i for i in range(max(len(content), len(self.key_content)))
+                if i >= len(content) or i >= len(self.key_content)
+                or content[i] != self.key_content[i]
+            ]
+            if changed:
+                self._update_keys(kb, changed)
+
+        self.keyboard = Keyboard()
+        self.keyboard.CopyFrom(kb)
+        self.key_content = content
+        return self.plate
+
+    def _update_keys(self, kb, changed):
+        old = [self.key_cutouts[i] for i in changed if i < len(self.key_cutouts)]
+
+        del self.key_cutouts[len(kb.keys):]
+        added = [i for i in changed if i < len(kb.keys)]
+        new = place_cutouts((kb.keys[i] for i in added),
+                            shift=CUTOUT_PADDING,
+                            tolerance=self.tolerance)
+        for i, cutout in zip(added, new):
+            if i < len(self.key_cutouts):
+                self.key_cutouts[i] = cutout
+            else:
+                self.key_cutouts.append(cutout)
+
+        # Put material back wherever an old or new cutout might be...
+        region = shapely.union_all(shapely.envelope([*old, *new]))
+        outline = shapely.geometry.polygon.Polygon(
+            (o.x, o.y) for o in kb.outline_polygon)
+        plate = self.plate.union(outline.intersection(region))
+
+        # ...then cut every current feature that reaches into that region
+        features = np.array(self.key_cutouts + self.hole_features,
+                            dtype=object)
+        nearby = shapely.STRtree(features).query(region,
+                                                 predicate="intersects")
+        self.plate = plate.difference(shapely.union_all(features[nearby]))
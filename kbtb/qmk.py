@@ -2,85 +2,86 @@
 
 import io
 import json
+from typing import NamedTuple
 
+import numpy as np
+
+from kbtb.keyboard import KeyArray
 from kbtb.keyboard_pb2 import Keyboard
+from kbtb.layout import key_topology
 
 
-def make_qmk_info_file(kb):
-    data = {}
+class QmkController(NamedTuple):
+    processor: str
+    bootloader: str
+    diode_direction: str
+    # QMK names of the controller's matrix pins, indexed by the keys'
+    # controller_pin_low and controller_pin_high fields
+    pin_names: list
 
-    if kb.name: data['keyboard_name'] = kb.name
-    if kb.url: data['url'] = kb.url
 
-    data['usb'] = {'pid': '0x23B0', 'device_ver': '0x0001'}
+_ATMEGA32U4 = QmkController('atmega32u4', 'atmel-dfu', 'COL2ROW', [
+    'B0',
+    'B7',
+    'D0',
+    'D1',
+    'D2',
+    'D3',
+    'D5',
+    'D4',
+    'D6',
+    'D7',
+    'B4',
+    'B5',
+    'B6',
+    'C6',
+    'C7',
+    'F7',
+    'F6',
+    'F5',
+    'F4',
+    'F1',
+    'F0',
+    'E6',
+])
 
-    # TODO: generalize...
-
-    if kb.controller == Keyboard.CONTROLLER_PROMICRO:
-        data['processor'] = 'atmega32u4'
-        data['bootloader'] = 'atmel-dfu'
-        data['diode_direction'] = 'COL2ROW'
-        pin_names = [
-            'D3', 'D2', 'D1', 'D0', 'D4', 'C6', 'D7', 'E6', 'B4', 'B5', 'B6',
-            'B2', 'B3', 'B1', 'F7', 'F6', 'F5', 'F4'
-        ]
-    elif (kb.controller == Keyboard.CONTROLLER_ATMEGA32U4
-          or kb.controller == Keyboard.CONTROLLER_ATMEGA32U4_HUB2):
-        data['processor'] = 'atmega32u4'
-        data['bootloader'] = 'atmel-dfu'
-        data['diode_direction'] = 'COL2ROW'
-        pin_names = [
-            'B0',
-            'B7',
-            'D0',
-            'D1',
-            'D2',
-            'D3',
-            'D5',
-            'D4',
-            'D6',
-            'D7',
-            'B4',
-            'B5',
-            'B6',
-            'C6',
-            'C7',
-            'F7',
-            'F6',
-            'F5',
-            'F4',
-            'F1',
-            'F0',
-            'E6',
-        ]
-    elif kb.controller == Keyboard.CONTROLLER_ATMEGA328:
-        data['processor'] = 'atmega328p'
-        data['bootloader'] = 'USBasp'
-        data['diode_direction'] = 'COL2ROW'
-        pin_names = [
-            "D0",
-            "D1",
-            "D4",
-            "D6",
-            "D7",
-            "B0",
-            "B1",
-            "B2",
-            "B3",
-            "B4",
-            "B5",
-            "C0",
-            "C1",
-            "C2",
-            "C3",
-            "C4",
-            "C5",
-        ]
-    elif kb.controller == Keyboard.CONTROLLER_STM32F072:
-        data['processor'] = 'STM32F072'
-        data['bootloader'] = 'stm32-dfu'
-        data['diode_direction'] = 'COL2ROW'
-        pin_names = [  # TODO: fix
+# TODO: generalize...
+CONTROLLERS = {
+    Keyboard.CONTROLLER_PROMICRO:
+    QmkController('atmega32u4', 'atmel-dfu', 'COL2ROW', [
+        'D3', 'D2', 'D1', 'D0', 'D4', 'C6', 'D7', 'E6', 'B4', 'B5', 'B6',
+        'B2', 'B3', 'B1', 'F7', 'F6', 'F5', 'F4'
+    ]),
+    Keyboard.CONTROLLER_ATMEGA32U4:
+    _ATMEGA32U4,
+    Keyboard.CONTROLLER_ATMEGA32U4_HUB2:
+    _ATMEGA32U4,
+    Keyboard.CONTROLLER_ATMEGA328:
+    QmkController('atmega328p', 'USBasp', 'COL2ROW', [
+        "D0",
+        "D1",
+        "D4",
+        "D6",
+        "D7",
+        "B0",
+        "B1",
+        "B2",
+        "B3",
+        "B4",
+        "B5",
+        "C0",
+        "C1",
+        "C2",
+        "C3",
+        "C4",
+        "C5",
+    ]),
+    Keyboard.CONTROLLER_STM32F072:
+    QmkController(
+        'STM32F072',
+        'stm32-dfu',
+        'COL2ROW',
+        [  # TODO: fix
             "D0",
             "D1",
             "D4",
@@ -98,9 +99,87 @@ def make_qmk_info_file(kb):
             "C3",
             "C4",
             "C5",
-        ]
-    else:
+        ]),
+}
+
+
+class QmkFiles(NamedTuple):
+    info_json: str
+    config_h: str
+    keymap_c: str
+
+
+def make_qmk_files(kb, topology="order"):
+    """Generate info.json, config.h and a default keymap.c together.
+
+    Every key is visited once to number the matrix rows and columns,
+    check the pin assignments, find the layout origin and collect the
+    poses for key_topology, so the cost grows linearly with the number
+    of keys. topology is a key_topology method or a KeyTopology already
+    found for kb.keys.
+    """
+    if kb.controller not in CONTROLLERS:
         raise RuntimeError(f'unknown controller: {kb.controller}')
+    controller = CONTROLLERS[kb.controller]
+    pin_names = controller.pin_names
+
+    # Number row and column controller pins in order of first use
+    rows, cols, cells, poses = {}, {}, set(), []
+    for k in kb.keys:
+        rows.setdefault(k.controller_pin_low, len(rows))
+        cols.setdefault(k.controller_pin_high, len(cols))
+        cells.add((k.controller_pin_low, k.controller_pin_high))
+        poses.append((k.pose.x, k.pose.y, k.pose.r))
+    keys = KeyArray(*np.array(poses, dtype=float).reshape(-1, 3).T)
+    min_x = float(keys.x.min(initial=float('inf')))
+    min_y = float(keys.y.min(initial=float('inf')))
+
+    # Sanity check the controller pins
+    if rows.keys() & cols.keys():
+        raise RuntimeError(f'pin in both row and column list '
+                           f'rows={list(rows)} cols={list(cols)}')
+    if not all(0 <= x < len(pin_names) for x in rows):
+        raise RuntimeError(f'rows contains out-of-range pin rows={list(rows)}')
+    if not all(0 <= x < len(pin_names) for x in cols):
+        raise RuntimeError(f'Rows contains out-of-range pin cols={list(cols)}')
+    if len(cells) != len(kb.keys):
+        raise RuntimeError(f'controller pin index assignments not unique')
+
+    row_pins = [pin_names[x] for x in rows]
+    col_pins = [pin_names[x] for x in cols]
+
+    layout_name, sequence = None, []
+    if kb.qmk.layout:
+        layout_name = f'LAYOUT_{kb.qmk.layout}'
+        sequence = kb.qmk.layout_sequence or [
+            # without an explicit sequence list keys in row-major order
+            i for row in key_topology(keys, method=topology).rows
+            for i in row
+        ]
+
+    return QmkFiles(
+        _info_json(kb, controller, rows, cols, row_pins, col_pins, sequence,
+                   layout_name, min_x, min_y),
+        _config_h(controller, row_pins, col_pins),
+        _keymap_c(kb, rows, cols, sequence, layout_name),
+    )
+
+
+def make_qmk_info_file(kb, topology="order"):
+    return make_qmk_files(kb, topology).info_json
+
+
+def _info_json(kb, controller, rows, cols, row_pins, col_pins, sequence,
+               layout_name, min_x, min_y):
+    data = {}
+
+    if kb.name: data['keyboard_name'] = kb.name
+    if kb.url: data['url'] = kb.url
+
+    data['usb'] = {'pid': '0x23B0', 'device_ver': '0x0001'}
+    data['processor'] = controller.processor
+    data['bootloader'] = controller.bootloader
+    data['diode_direction'] = controller.diode_direction
 
     data['features'] = {
         "backlight": False,
@@ -114,40 +193,17 @@ def make_qmk_info_file(kb):
         "unicode": False
     }
 
-    # Build sets of row and column controller pin indices
-    rows = list(dict.fromkeys(k.controller_pin_low for k in kb.keys))
-    cols = list(dict.fromkeys(k.controller_pin_high for k in kb.keys))
-
-    # Sanity check the controller pins
-    if set(rows) & set(cols):
-        raise RuntimeError(
-            f'pin in both row and column list rows={rows} cols={cols}')
-    if not set(rows).issubset(range(len(pin_names))):
-        raise RuntimeError(f'rows contains out-of-range pin rows={rows}')
-    if not set(cols).issubset(range(len(pin_names))):
-        raise RuntimeError(f'Rows contains out-of-range pin cols={cols}')
-    if len(
-            set((k.controller_pin_low, k.controller_pin_high)
-                for k in kb.keys)) != len(kb.keys):
-        raise RuntimeError(f'controller pin index assignments not unique')
-
     data['width'] = len(cols)
     data['height'] = len(rows)
     data['key_count'] = len(kb.keys)
-    data['matrix_pins'] = {
-        'cols': list(pin_names[x] for x in cols),
-        'rows': list(pin_names[x] for x in rows)
-    }
+    data['matrix_pins'] = {'cols': col_pins, 'rows': row_pins}
 
     ku = 19.05
-    min_x = min(k.pose.x for k in kb.keys)
-    min_y = min(k.pose.y for k in kb.keys)
 
     def make_layout(key):
         data = {}
         data['matrix'] = [
-            rows.index(key.controller_pin_low),
-            cols.index(key.controller_pin_high)
+            rows[key.controller_pin_low], cols[key.controller_pin_high]
         ]
         if key.unit_width != 1: data['w'] = key.unit_width
         if key.unit_height != 1: data['h'] = key.unit_height
@@ -157,21 +213,51 @@ def make_qmk_info_file(kb):
 
         return data
 
-    if kb.qmk.layout and kb.qmk.layout_sequence:
-        data["community_layouts"] = [kb.qmk.layout]
-        data['layouts'] = {
-            f'LAYOUT_{kb.qmk.layout}': {
-                'key_count': len(kb.qmk.layout_sequence),
-                'layout':
-                [make_layout(kb.keys[i]) for i in kb.qmk.layout_sequence]
-            }
-        }
-    elif kb.qmk.layout and not kb.qmk.layout_sequence:
+    if layout_name:
         data["community_layouts"] = [kb.qmk.layout]
         data['layouts'] = {
-            f'LAYOUT_{kb.qmk.layout}': {
-                'key_count': len(kb.keys),
-                'layout': [make_layout(k) for k in kb.keys]
+            layout_name: {
+                'key_count': len(sequence),
+                'layout': [make_layout(kb.keys[i]) for i in sequence]
             }
         }
     return json.dumps(data, indent=2)
+
+
+def _config_h(controller, row_pins, col_pins):
+    out = io.StringIO()
+    out.write('#pragma once\n\n')
+    out.write(f'#define MATRIX_ROWS {len(row_pins)}\n')
+    out.write(f'#define MATRIX_COLS {len(col_pins)}\n\n')
+    out.write(f'#define MATRIX_ROW_PINS {{ {", ".join(row_pins)} }}\n')
+    out.write(f'#define MATRIX_COL_PINS {{ {", ".join(col_pins)} }}\n\n')
+    out.write(f'#define DIODE_DIRECTION {controller.diode_direction}\n')
+    return out.getvalue()
+
+
+def _keymap_c(kb, rows, cols, sequence, layout_name):
+    """A single layer of KC_NO, one line per matrix row."""
+    out = io.StringIO()
+    out.write('#include QMK_KEYBOARD_H\n\n')
+    out.write('const uint16_t PROGMEM '
+              'keymaps[][MATRIX_ROWS][MATRIX_COLS] = {\n')
+
+    if layout_name:
+        lines, last_row = [], None
+        for i in sequence:
+            row = rows[kb.keys[i].controller_pin_low]
+            if row != last_row:
+                lines.append([])
+                last_row = row
+            lines[-1].append('KC_NO')
+        out.write(f'    [0] = {layout_name}(\n')
+        out.write(',\n'.join('        ' + ', '.join(line) for line in lines))
+        out.write('\n    ),\n')
+    else:
+        out.write('    [0] = {\n')
+        for _ in rows:
+            out.write(f'        {{{", ".join(["KC_NO"] * len(cols))}}},\n')
+        out.write('    },\n')
+
+    out.write('};\n')
+    return out.getvalue()
@@ -2,9 +2,12 @@
 
 import xml.etree.ElementTree as ET
 import io
-from math import sin, cos, atan2, degrees, radians
+from math import ceil, sin, cos, atan2, degrees, radians
+from xml.sax.saxutils import escape
 
-from kbtb.plate import generate_plate
+import shapely
+
+from kbtb.plate import generate_plate, place_cutouts
 
 
 def shape_to_svg_element(shape, props={}, x_scale=1, y_scale=-1):
@@ -42,8 +45,38 @@ def shape_to_svg(shape, props={}, x_scale=1, y_scale=-1):
     return ET.ElementTree(root)
 
 
-def keyboard_to_layout_svg(kb, add_numbers=True):
-    plate = generate_plate(kb)
+def _number(value, precision):
+    """Format a coordinate with at most precision decimal places."""
+    if precision is None:
+        return repr(float(value))
+    text = f"{value:.{precision}f}".rstrip("0").rstrip(".")
+    return "0" if text == "-0" else text
+
+
+def _path_data(shape, x_scale, y_scale, precision):
+    for ring in (shape.exterior, *shape.interiors):
+        yield " M "
+        yield " ".join(
+            f"{_number(x_scale * x, precision)},{_number(y_scale * y, precision)}"
+            for x, y in ring.coords)
+        yield " Z "
+
+
+def write_layout_svg(kb, output, add_numbers=True, plate=None, precision=3):
+    """Stream a layout preview svg to a path or binary file object.
+
+    Coordinates are written with at most precision decimal places, or
+    with full float precision when precision is None.
+    """
+    if isinstance(output, (str, bytes)) or hasattr(output, '__fspath__'):
+        with open(output, 'wb') as fp:
+            return write_layout_svg(kb, fp, add_numbers, plate, precision)
+
+    if plate is None:
+        plate = generate_plate(kb)
+
+    out = io.TextIOWrapper(output, encoding="utf-8", newline="")
+    n = lambda value: _number(value, precision)
 
     x_scale = 1
     y_scale = -1
@@ -55,68 +88,143 @@ def keyboard_to_layout_svg(kb, add_numbers=True):
     width = abs(x_scale * x_min - x_scale * x_max)
     height = abs(y_scale * y_min - y_scale * y_max)
 
-    # Create the empty svg tree
-    root = ET.Element(
-        'svg', {
-            "viewBox": f"{left} {top} {width} {height}",
-            "xmlns": "http://www.w3.org/2000/svg",
-            "xmlns:xlink": "http://www.w3.org/1999/xlink",
-        })
-    root.append(ET.Comment(f'physical-dimensions: {width} mm by {height} mm'))
-
-    # Add groups for document structure
-    g_plate = ET.SubElement(root, "g", {
-        "id": "plate",
-        "style": "fill: black; fill-rule: evenodd;",
-    })
-    g_plate = ET.SubElement(g_plate, "g", {"id": "plate"})
-    g_keycaps = ET.SubElement(root, "g", {
-        "id": "keycaps",
-        "style": "fill: white;"
-    })
+    out.write(f'<svg viewBox="{n(left)} {n(top)} {n(width)} {n(height)}" '
+              'xmlns="http://www.w3.org/2000/svg" '
+              'xmlns:xlink="http://www.w3.org/1999/xlink">')
+    out.write(f'<!--physical-dimensions: {n(width)} mm by {n(height)} mm-->')
+
+    # Each distinct keycap size is defined once and placed with <use>
+    keyboard_unit = 19.05
+    margin = keyboard_unit - 18.42
+    keycap_ids = {}
+    for key in kb.keys:
+        size = (n(keyboard_unit * key.unit_width - margin),
+                n(keyboard_unit * key.unit_height - margin))
+        keycap_ids.setdefault(size, f"keycap-{len(keycap_ids)}")
+
+    out.write('<defs>')
+    for (w, h), keycap_id in keycap_ids.items():
+        out.write(f'<rect id="{keycap_id}" width="{w}" height="{h}" '
+                  f'x="{n(float(w) / -2)}" y="{n(float(h) / -2)}" rx="1" />')
+    out.write('</defs>')
 
     # Add plate
-    ET.SubElement(
-        g_plate, "path", {
-            "d":
-            " M " + " ".join(f"{x_scale*x},{y_scale*y}"
-                             for x, y in plate.exterior.coords) + " Z " +
-            " ".join((" M " + " ".join(f"{x_scale*x},{y_scale*y}"
-                                       for x, y in i.coords) + " Z ")
-                     for i in plate.interiors)
-        })
-
-    g_plate.append(
-        shape_to_svg_element(plate, {"style": "fill: black;"}, x_scale,
-                             y_scale))
+    out.write('<g id="plate" style="fill: black; fill-rule: evenodd;">'
+              '<path d="')
+    out.writelines(_path_data(plate, x_scale, y_scale, precision))
+    out.write('" /></g>')
 
+    # Add keycaps
+    out.write('<g id="keycaps" style="fill: white;">')
     for i, key in enumerate(kb.keys):
         x, y = x_scale * key.pose.x, y_scale * key.pose.y
         r = degrees(
             atan2(y_scale * sin(radians(key.pose.r - 90)),
                   x_scale * cos(radians(key.pose.r - 90)))) + 90
 
-        keyboard_unit = 19.05
-        margin = keyboard_unit - 18.42
-        ET.SubElement(
-            g_keycaps, "rect", {
-                "width": str(keyboard_unit * key.unit_width - margin),
-                "height": str(keyboard_unit * key.unit_height - margin),
-                "x": str((keyboard_unit * key.unit_width - margin) / -2),
-                "y": str((keyboard_unit * key.unit_height - margin) / -2),
-                "rx": "1",
-                "transform": f"translate({x} {y}) rotate({r})"
-            })
+        keycap_id = keycap_ids[(n(keyboard_unit * key.unit_width - margin),
+                                n(keyboard_unit * key.unit_height - margin))]
+        out.write(f'<use xlink:href="#{keycap_id}" '
+                  f'transform="translate({n(x)} {n(y)}) rotate({n(r)})" />')
         if add_numbers:
-            ET.SubElement(
-                g_keycaps, "text", {
-                    "style":
-                    "fill: black; font-family: sans-serif; font-size: 5;",
-                    "transform": f"translate({x} {y}) rotate({180+r}) ",
-                    "alignment-baseline": "middle",
-                    "text-anchor": "middle",
-                }).text = f"{i}"
-    return ET.ElementTree(root)
+            out.write(
+                '<text style="fill: black; font-family: sans-serif; '
+                f'font-size: 5;" transform="translate({n(x)} {n(y)}) '
+                f'rotate({n(180 + r)}) " alignment-baseline="middle" '
+                f'text-anchor="middle">{i}</text>')
+    out.write('</g></svg>')
+
+    out.flush()
+    out.detach()
+
+
+def keyboard_to_layout_svg(kb, add_numbers=True, plate=None, precision=3):
+    """Build a layout preview svg as an ElementTree, see write_layout_svg."""
+    svg = keyboard_to_layout_svg_file(kb, add_numbers, plate, precision)
+    return ET.ElementTree(ET.fromstring(svg))
+
+
+def keyboard_to_layout_svg_file(kb, add_numbers=True, plate=None,
+                                precision=3):
+    """Build a layout preview svg file, see write_layout_svg."""
+    f = io.BytesIO()
+    write_layout_svg(kb, f, add_numbers, plate, precision)
+    return f.getvalue()
+
+
+def thumbnail_plate(kb):
+    """A cheap approximation of the top plate for small previews.
+
+    Returns the outline and the unrounded cutouts without subtracting
+    them; drawn with an evenodd fill the cutouts still show as holes.
+    """
+    cutouts = place_cutouts(kb.keys, corner_radius=0)
+    if kb.outline_polygon:
+        outline = shapely.geometry.Polygon(
+            (o.x, o.y) for o in kb.outline_polygon)
+    else:
+        outline = shapely.envelope(shapely.union_all(cutouts))
+    return [outline, *cutouts]
+
+
+def write_catalog_svg(keyboards,
+                      output,
+                      columns=8,
+                      cell_size=200,
+                      gap=20,
+                      detail=0.5,
+                      labels=True,
+                      precision=1):
+    """Stream a contact sheet of many keyboards to a binary file object.
+
+    Each keyboard is scaled to fit a cell_size square and drawn with a
+    thumbnail plate. Geometry is simplified with a tolerance of detail
+    sheet units, so lower detail values keep more of the shape.
+    """
+    keyboards = list(keyboards)
+    rows = ceil(len(keyboards) / columns)
+    label_size = gap / 2 if labels else 0
+    width = columns * (cell_size + gap) + gap
+    height = rows * (cell_size + gap + label_size) + gap
+
+    out = io.TextIOWrapper(output, encoding="utf-8", newline="")
+    out.write(f'<svg viewBox="0 0 {width} {height}" '
+              'xmlns="http://www.w3.org/2000/svg">')
+    out.write('<g style="fill: black; fill-rule: evenodd;">')
+
+    for i, kb in enumerate(keyboards):
+        cell_x = gap + (i % columns) * (cell_size + gap)
+        cell_y = gap + (i // columns) * (cell_size + gap + label_size)
+
+        geoms = thumbnail_plate(kb)
+        x_min, y_min, x_max, y_max = geoms[0].bounds
+        scale = cell_size / max(x_max - x_min, y_max - y_min, 1e-9)
+        x_off = cell_x + (cell_size - scale * (x_max - x_min)) / 2
+        y_off = cell_y + (cell_size - scale * (y_max - y_min)) / 2
+
+        # Map to sheet units with +y downwards before simplifying
+        geoms = shapely.transform(
+            geoms, lambda c: (c - (x_min, y_max)) * (scale, -scale) +
+            (x_off, y_off))
+        geoms = shapely.simplify(geoms, detail)
+
+        out.write('<path d="')
+        for geom in geoms:
+            for part in getattr(geom, "geoms", [geom]):
+                if not part.is_empty:
+                    out.writelines(_path_data(part, 1, 1, precision))
+        out.write('" />')
+
+        if labels:
+            out.write(f'<text x="{cell_x + cell_size / 2}" '
+                      f'y="{cell_y + cell_size + label_size}" '
+                      f'style="font-family: sans-serif; '
+                      f'font-size: {label_size * 0.8};" '
+                      f'text-anchor="middle">{escape(kb.name)}</text>')
+
+    out.write('</g></svg>')
+    out.flush()
+    out.detach()
 
 
 def svg_to_file(svg):
@@ -0,0 +1,114 @@
+"""Explore parametric layouts by evaluating many variants.
+
+A sweep calls a layout-building function with every combination of a
+parameter grid, measures each resulting Keyboard with cheap geometric
+metrics and streams one record per variant to a CSV or JSONL file:
+
+    sweep(unisplit42,
+          parameter_grid(angle=range(40, 60), arc_radius=[70, 90, 110]),
+          "unisplit42_sweep.csv")
+
+The build function must be importable by worker processes, so it needs
+to be defined at module level.
+"""
+
+import csv
+import functools
+import itertools
+import json
+import multiprocessing
+
+import shapely
+
+from kbtb.layout import key_bounds
+from kbtb.validate import validate_keyboard
+
+METRICS = [
+    "key_count",
+    "outline_area",
+    "width",
+    "height",
+    "key_overlap_area",
+    "min_hole_clearance",
+    "conflicts",
+]
+
+
+def parameter_grid(**values):
+    """Yield a dict for every combination of the given parameter values."""
+    names = list(values)
+    for combination in itertools.product(*values.values()):
+        yield dict(zip(names, combination))
+
+
+def layout_metrics(kb):
+    """Measure a keyboard without generating any artifacts.
+
+    Key overlap is the total area shared by pairs of key placeholders.
+    Hole clearance is the smallest distance from a mounting hole's edge
+    to an unrounded switch cutout and conflicts counts the problems
+    found by kbtb.validate.validate_keyboard.
+    """
+    x_min, y_min, x_max, y_max = key_bounds(kb.keys)
+
+    if kb.outline_polygon:
+        outline_area = shapely.geometry.Polygon(
+            (o.x, o.y) for o in kb.outline_polygon).area
+    else:
+        outline_area = (x_max - x_min) * (y_max - y_min)
+
+    report = validate_keyboard(kb)
+    overlap = sum(c.overlap_area for c in report.conflicts
+                  if c.a.kind == c.b.kind == "key")
+
+    return {
+        "key_count": len(kb.keys),
+        "outline_area": outline_area,
+        "width": x_max - x_min,
+        "height": y_max - y_min,
+        "key_overlap_area": overlap,
+        "min_hole_clearance": report.min_clearance.get(("cutout", "hole")),
+        "conflicts": len(report.conflicts),
+    }
+
+
+def evaluate(build, params):
+    """Build one variant and return its parameters and metrics."""
+    record = dict(params)
+    record.update(dict.fromkeys(METRICS))
+    try:
+        record.update(layout_metrics(build(**params)))
+        record["error"] = None
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def sweep(build, grid, output, format=None, processes=None, chunksize=8):
+    """Evaluate build for every parameter set in grid across processes.
+
+    Records are written to output (a path ending in .csv or .jsonl, or
+    an explicit format) in grid order as soon as they are available, so
+    large sweeps never hold every result in memory. Returns the number
+    of variants evaluated.
+    """
+    if format is None:
+        format = "csv" if output.endswith(".csv") else "jsonl"
+    if format not in ("csv", "jsonl"):
+        raise RuntimeError(f"unknown format: {format}")
+
+    count = 0
+    with open(output, "w", newline="") as fp, \
+            multiprocessing.Pool(processes) as pool:
+        writer = None
+        for record in pool.imap(functools.partial(evaluate, build), grid,
+                                chunksize=chunksize):
+            if format == "jsonl":
+                fp.write(json.dumps(record, default=str) + "\n")
+            else:
+                if writer is None:
+                    writer = csv.DictWriter(fp, fieldnames=list(record))
+                    writer.writeheader()
+                writer.writerow(record)
+            count += 1
+    return count
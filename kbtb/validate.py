@@ -0,0 +1,160 @@
+"""Check a keyboard for colliding keys, cutouts, holes and parts.
+
+All features are indexed in a single STRtree so that finding every
+conflicting pair and the minimum clearance between each kind of
+feature takes O(n log n) rather than comparing every pair.
+
+    report = validate_keyboard(kb)
+    for conflict in report.conflicts:
+        print(conflict)
+"""
+
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+import shapely
+
+from kbtb.keyboard_pb2 import Keyboard
+from kbtb.layout import generate_placeholders, rect_corners
+from kbtb.plate import place_cutouts, place_holes
+
+# Approximate footprint (width, height, x offset, y offset) of each
+# controller relative to controller_pose, matching the placement in
+# kbtb.pcb.
+CONTROLLER_FOOTPRINTS = {
+    # Pro Micro module, rotated and shifted down as in controller_pro_micro
+    Keyboard.CONTROLLER_PROMICRO: (33.02, 17.78, 0, -(17.78 - 9.525)),
+    Keyboard.CONTROLLER_STM32F072: (9, 9, 0, 0),  # LQFP-48
+    Keyboard.CONTROLLER_ATMEGA32U4: (12, 12, 0, 0),  # TQFP-44
+    Keyboard.CONTROLLER_ATMEGA328: (9, 9, 0, 0),  # TQFP-32
+    Keyboard.CONTROLLER_ATMEGA32U4_HUB2: (12, 12, 0, 0),  # TQFP-44
+}
+
+# HRO TYPE-C-31-M-12 footprint
+CONNECTOR_FOOTPRINT = (8.94, 7.3, 0, 0)
+
+# Minimum distance in milimeters required between each pair of feature
+# kinds that must not collide. Keys overlap their own cutouts and the
+# Pro Micro sits over switches, so those pairs are left out.
+CLEARANCES = {
+    ("key", "key"): 0,
+    ("cutout", "cutout"): 1,
+    ("cutout", "hole"): 0.5,
+    ("hole", "hole"): 1,
+    ("controller", "hole"): 0.5,
+    ("connector", "cutout"): 0.5,
+    ("connector", "hole"): 0.5,
+    ("connector", "controller"): 0.5,
+}
+
+
+class Feature(NamedTuple):
+    kind: str  # key, cutout, hole, controller or connector
+    index: int  # index into kb.keys or kb.hole_positions
+
+
+class Conflict(NamedTuple):
+    a: Feature
+    b: Feature
+    distance: float
+    overlap_area: float
+
+
+class ValidationReport(NamedTuple):
+    features: List[Feature]
+    geometry: np.ndarray
+    conflicts: List[Conflict]
+    # Smallest distance between any two features of each checked pair
+    # of kinds, zero when they touch or overlap.
+    min_clearance: Dict[Tuple[str, str], float]
+
+    @property
+    def ok(self):
+        return not self.conflicts
+
+
+def footprint(pose, size):
+    """Rectangle of the given (width, height, x, y) size at a pose."""
+    width, height, x, y = size
+    theta = np.radians(pose.r)
+    cx = pose.x + np.cos(theta) * x - np.sin(theta) * y
+    cy = pose.y + np.sin(theta) * x + np.cos(theta) * y
+    return shapely.polygons(
+        rect_corners([cx], [cy], [pose.r], width, height, 1)[0])
+
+
+def keyboard_features(kb):
+    """Return the features of a keyboard and their geometry."""
+    features, geoms = [], []
+
+    def add(kind, shapes):
+        features.extend(Feature(kind, i) for i in range(len(shapes)))
+        geoms.extend(shapes)
+
+    if kb.keys:
+        add("key", generate_placeholders(kb.keys).geoms)
+        add("cutout", place_cutouts(kb.keys, corner_radius=0))
+    if kb.hole_positions:
+        add("hole", place_holes(kb.hole_positions, kb.hole_diameter))
+    if (kb.controller in CONTROLLER_FOOTPRINTS and
+            kb.HasField("controller_pose")):
+        add("controller", [
+            footprint(kb.controller_pose,
+                      CONTROLLER_FOOTPRINTS[kb.controller])
+        ])
+    if kb.HasField("connector_pose"):
+        add("connector", [footprint(kb.connector_pose, CONNECTOR_FOOTPRINT)])
+
+    return features, np.array(geoms, dtype=object)
+
+
+def validate_keyboard(kb, clearances=CLEARANCES, area_tolerance=1e-3):
+    """Find every pair of features that overlap or are too close.
+
+    Features closer than their entry in clearances are reported, as are
+    features overlapping by more than area_tolerance square milimeters
+    so that neighbouring keys which merely share an edge pass.
+    """
+    clearances = {tuple(sorted(k)): v for k, v in clearances.items()}
+    features, geoms = keyboard_features(kb)
+    kinds = np.array([f.kind for f in features])
+    tree = shapely.STRtree(geoms)
+
+    distance = max(clearances.values(), default=0)
+    if distance > 0:
+        a, b = tree.query(geoms, predicate="dwithin", distance=distance)
+    else:
+        a, b = tree.query(geoms, predicate="intersects")
+    pairs = a < b
+    a, b = a[pairs], b[pairs]
+    required = np.array([
+        clearances.get(tuple(sorted(k)), np.nan)
+        for k in zip(kinds[a], kinds[b])
+    ], dtype=float)
+    checked = ~np.isnan(required)
+    a, b, required = a[checked], b[checked], required[checked]
+
+    distance = shapely.distance(geoms[a], geoms[b])
+    area = shapely.area(shapely.intersection(geoms[a], geoms[b]))
+    bad = (area > area_tolerance) | (distance < required)
+    conflicts = [
+        Conflict(features[i], features[j], float(d), float(s))
+        for i, j, d, s in zip(a[bad], b[bad], distance[bad], area[bad])
+    ]
+
+    min_clearance = {}
+    for kind_a, kind_b in sorted(clearances):
+        source = np.flatnonzero(kinds == kind_a)
+        target = np.flatnonzero(kinds == kind_b)
+        if not len(source) or not len(target):
+            continue
+        if kind_a == kind_b and len(source) < 2:
+            continue
+        _, distances = shapely.STRtree(geoms[target]).query_nearest(
+            geoms[source],
+            return_distance=True,
+            exclusive=kind_a == kind_b,
+            all_matches=False)
+        min_clearance[(kind_a, kind_b)] = float(distances.min())
+
+    return ValidationReport(features, geoms, conflicts, min_clearance)